@@ -1,8 +1,16 @@
 import io
+import os
+import itertools
 import numpy as np
 
 from pymatgen.io.atat import Mcsqs
 
+from candidate_store import CandidateStore, save_store, store_path
+
+
+# number of candidates rendered before they are written to the file in one go
+WRITE_BLOCK_SIZE = 10000
+
 
 def pmg_to_atat_str(structure, mixing=None, supercell=np.eye(3), species = [], direct=True):
     or_cell = (structure.lattice.matrix)
@@ -12,7 +20,8 @@ def pmg_to_atat_str(structure, mixing=None, supercell=np.eye(3), species = [], d
     #convert original unit cell into coordinate_system
     if direct:
         cell=supercell
-        coord_sys = np.matmul(or_cell, np.linalg.inv(supercell))
+        # the rows of or_cell are the supercell vectors supercell @ (parent vectors)
+        coord_sys = np.matmul(np.linalg.inv(supercell), or_cell)
         coords = np.matmul(structure.frac_coords, supercell)
     else:
         cell=or_cell
@@ -30,7 +39,7 @@ def pmg_to_atat_str(structure, mixing=None, supercell=np.eye(3), species = [], d
     
     #if it's a lat.in then change the first mixing element to both in the lat.in
     if mixing != None:
-        output = output.replace(mixing[0], f"{mixing[0]}, {mixing[1]}")
+        output = output.replace(mixing[0], ", ".join(mixing))
     
     return output
 
@@ -47,29 +56,65 @@ def sqs_list_to_pmg(sqs_list):
 
 
 def configs_to_atat_str(structure, configs, mixing_sites, supercell):
-    
-    output = ""
+    return "".join(iter_atat_str(structure, configs, mixing_sites, supercell))
+
+
+def write_configs(path, structure, configs, mixing_sites, supercell, block_size=WRITE_BLOCK_SIZE):
+    # same content as configs_to_atat_str, written in blocks of candidates
+    num_configs = 0
+    with open(path, 'w') as f:
+        for block in itertools.batched(iter_atat_str(structure, configs, mixing_sites, supercell), block_size):
+            f.write("".join(block))
+            num_configs += len(block)
+
+    return num_configs
+
+
+def write_config_store(path, structure, configs, mixing_sites, supercell, block_size=WRITE_BLOCK_SIZE):
+    # binary counterpart of write_configs, see candidate_store - only the packed occupations grow with the number of candidates
+    symbols = [el.symbol for el in structure.species]
+    positions = structure.indices_from_symbol(mixing_sites[0])
+    mixing_atoms = np.arange(positions[0], positions[-1] + 1)
+
+    if len(mixing_sites) != 2:
+        raise ValueError(f"The binary candidate store only supports binary mixing sites, not {mixing_sites}")
+
+    packed = [np.zeros((0, (len(mixing_atoms) + 7)//8), dtype='uint8')]
+    for block in itertools.batched(configs, block_size):
+        packed.append(np.packbits(np.array(block, dtype='uint8').reshape(-1, len(mixing_atoms)), axis=1))
+    packed = np.concatenate(packed, axis=0)
+
+    save_store(path, atat_template(structure, supercell), symbols, mixing_atoms, mixing_sites, packed, len(mixing_atoms))
+    return packed.shape[0]
+
+
+def iter_atat_str(structure, configs, mixing_sites, supercell):
+    # the coordinate system, cell and coordinates are the same for all candidates, so they are rendered once
+    # and every candidate only fills in its species (configs are occupation arrays, i.e. indices into mixing_sites)
+    template = atat_template(structure, supercell)
+    symbols = [el.symbol for el in structure.species]
+    positions = structure.indices_from_symbol(mixing_sites[0])
+    species = np.array(mixing_sites)
 
     for config in configs:
-        species = adjust_chemical_species(
-            structure   = structure, 
-            config      = config, 
-            mixing_site = mixing_sites[0])
-        
-        output += f"{pmg_to_atat_str(
-            structure   = structure, 
-            supercell   = supercell, 
-            species     = species)}\nend\n\n"
-    
-    return output
+        symbols[positions[0]:positions[-1] + 1] = species[config].tolist()
+        yield template.format(*symbols)
 
 
-def adjust_chemical_species(structure, config, mixing_site):
-    
+def atat_template(structure, supercell=np.eye(3)):
+    # output of pmg_to_atat_str (plus the end of the sqs) with a format field in place of every species
+    return f"{pmg_to_atat_str(
+        structure   = structure, 
+        supercell   = supercell, 
+        species     = ['{}'] * len(structure))}\nend\n\n"
+
+
+def adjust_chemical_species(structure, config, mixing_sites):
+    # config is an occupation array, the index into mixing_sites for every mixing site
     symbols = [el.symbol for el in structure.species]
-    positions = structure.indices_from_symbol(mixing_site)
+    positions = structure.indices_from_symbol(mixing_sites[0])
     
-    symbols[positions[0]:positions[-1] + 1] = config
+    symbols[positions[0]:positions[-1] + 1] = np.array(mixing_sites)[config].tolist()
 
     return symbols
 
@@ -83,19 +128,36 @@ def write_lat_list(path, sqs_list, supercell=np.eye(3)):
 
 
 def read_in_lat_list(path):
-    content = [line.rstrip() for line in open(path, 'r').readlines()]
+    return list(iter_lat_list(path))
 
-    sqs_list = []
-    single_sqs = []
 
-    for line in content:
+def iter_candidates(path):
+    # candidates of a sqs.out type file or, if there is none, of its binary store
+    if not os.path.exists(path) and os.path.exists(store_path(path)):
+        return CandidateStore(store_path(path)).iter_lat_list()
+    return iter_lat_list(path)
 
-        if line == '':
-            sqs_list.append(single_sqs)
-            single_sqs = []
-        
-        elif line != 'end':
-            single_sqs.append(line)
 
+def select_candidates(path, indices):
+    # {index: candidate} for the given candidate indices, a binary store only renders these
+    indices = set(indices)
+    if not os.path.exists(path) and os.path.exists(store_path(path)):
+        store = CandidateStore(store_path(path))
+        return {idx: store.lines(idx) for idx in sorted(indices)}
+    return {idx: sqs for idx, sqs in enumerate(iter_lat_list(path)) if idx in indices}
+
+
+def iter_lat_list(path):
+    # yields one sqs (list of lines) at a time, so the whole candidate file never has to be in memory
+    single_sqs = []
+
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip()
+
+            if line == '':
+                yield single_sqs
+                single_sqs = []
         
-    return sqs_list
\ No newline at end of file
+            elif line != 'end':
+                single_sqs.append(line)
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+""" Binary alternative to the sqs.out text file of the candidates (binary mixing site only)
+
+    All candidates of a concentration share the coordinate system, cell and coordinates, only the species
+    of the mixing sites differ. The store ('{candidate file}.npz', e.g. sqs.out.npz) holds the text of the
+    shared part once (with a format field per species) and one bit per mixing site and candidate
+    (0 for the first, 1 for the second mixing species). The text of a candidate is only rendered on demand.
+"""
+
+STORE_SUFFIX = '.npz'
+
+
+def store_path(path):
+    return f"{path}{STORE_SUFFIX}"
+
+
+class CandidateStore:
+
+    def __init__(self, path: str):
+        """
+        Input:
+        * path - path of the store, e.g. 'calc/sqs_03/sqs.out.npz'
+
+        Use --> loads the shared text and the packed occupations:
+                    self.template - text of a candidate in the sqs.out format with a format field for every species
+                    self.symbols - species of all atoms, the ones of the mixing sites are replaced per candidate
+                    self.mixing_atoms - atom indices of the mixing sites
+                    self.species - the two species of the mixing site
+
+        Returns => None
+        """
+        with np.load(path, allow_pickle=False) as data:
+            self.template = str(data['template'])
+            self.symbols = data['symbols'].tolist()
+            self.mixing_atoms = data['mixing_atoms']
+            self.species = data['species'].tolist()
+            self.packed = data['occupations']
+            self.num_sites = int(data['num_sites'])
+
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+
+    def occupations(self, start=0, stop=None):
+        # uint8 array of shape (number of candidates, number of mixing sites), 1 where the second species sits
+        return np.unpackbits(self.packed[start:stop], axis=1, count=self.num_sites)
+
+
+    def render(self, idx):
+        # text of candidate idx, exactly as written to sqs.out
+        symbols = self.symbols.copy()
+        for atom, bit in zip(self.mixing_atoms.tolist(), self.occupations(idx, idx + 1)[0].tolist()):
+            symbols[atom] = self.species[bit]
+        return self.template.format(*symbols)
+
+
+    def lines(self, idx):
+        # candidate idx as a list of lines, like the sqs yielded by atat_lattice_file.iter_lat_list
+        return [line for line in self.render(idx).split("\n") if line != '' and line != 'end']
+
+
+    def iter_lat_list(self):
+        for idx in range(len(self)):
+            yield self.lines(idx)
+
+
+    def write_text(self, path, block_size=10000):
+        # renders all candidates to a sqs.out type file, e.g. for corrdump
+        with open(path, 'w') as f:
+            for start in range(0, len(self), block_size):
+                f.write("".join([self.render(idx) for idx in range(start, min(start + block_size, len(self)))]))
+
+
+    def mirrored(self, path):
+        # store with the two species exchanged on every mixing site
+        save_store(path, self.template, self.symbols, self.mixing_atoms, self.species, self.packed ^ np.uint8(0xFF), self.num_sites)
+
+
+def save_store(path, template, symbols, mixing_atoms, species, packed, num_sites):
+    # the padding bits of the last byte are never unpacked, so they don't have to be cleared
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, template=np.array(template), symbols=np.array(symbols), mixing_atoms=np.asarray(mixing_atoms, dtype='int64'),
+                            species=np.array(species), occupations=packed, num_sites=np.array(num_sites))
@@ -0,0 +1,206 @@
+import os
+import sys
+import glob
+import argparse
+import tempfile
+
+import numpy as np
+
+from pymatgen.core.structure import Structure
+
+from atat_lattice_file import iter_atat_str, pmg_to_atat_str
+from config_generator import canonical_keys, canonical_weights, generate_candidate_configurations, site_counts
+from select_sym_best import occupation_keys
+from symmetry import HAS_BSYM, count_unique_compositions, parent_permutations, symmetry_permutations
+
+
+""" Consistency checks of the native enumerator and of the canonical occupation keys on the example inputs
+
+    For a binary and a multicomponent (ternary) mixing site and every composition of the supercell:
+        * the permutations built from the parent cell form a group
+        * the native candidates have the requested composition, are the lexicographically smallest member of their orbit,
+          are pairwise symmetry distinct and as many as the Burnside count predicts, i.e. every orbit is found exactly once
+        * the occupation keys of select_sym_best, computed from the rendered candidates and the lat.in, are distinct
+          for the candidates and the same for a symmetry equivalent image of every candidate
+    None of this needs bsym. If it is installed, the permutations and the candidates are also compared with the ones of bsym.
+    Every failed check is reported and the script exits with 1.
+"""
+
+def main():
+    parser = argparse.ArgumentParser("Enumeration Check")
+
+    parser.add_argument('-i', '--inputs', dest='inputs', nargs='+', default=None,
+                        help='Input directories containing the base structure - Defaults to the input directories of the examples next to the code')
+    parser.add_argument('--base_str', dest='base_path', default='base.vasp',
+                        help='The path of the input structure, relative to the input directory - Defaults to \'base.vasp\'')
+    parser.add_argument('-mix', '--mixing_sites', dest='mixing', nargs='+', default=['Nb', 'Ta'],
+                        help='Binary check: alloying sites (first argument) and the replacement element - Defaults to Nb Ta as in the examples')
+    parser.add_argument('--super_cell_long', nargs=9, dest='sc_matrix', default=[2, 0, 0, 0, 2, 0, 0, 0, 2],
+                        help='Binary check: supercell matrix - Defaults to 2 0 0 0 2 0 0 0 2 as in the examples')
+    parser.add_argument('--multi_mixing_sites', dest='multi_mixing', nargs='+', default=['Nb', 'Ta', 'V'],
+                        help='Multicomponent check: alloying sites (first argument) and the replacement elements - Defaults to Nb Ta V')
+    parser.add_argument('--multi_super_cell_long', nargs=9, dest='multi_sc_matrix', default=[-1, 1, 1, 1, -1, 1, 1, 1, -1],
+                        help='Multicomponent check: supercell matrix, small enough for all compositions - Defaults to -1 1 1 1 -1 1 1 1 -1 (keeps the point group of the examples)')
+    parser.add_argument('--symprec', dest='symprec', type=float, default=1e-2,
+                        help='Tolerance (in Angstrom) of the symmetry detection of the base structure - Defaults to 1e-2')
+    parser.add_argument('--tolerance', dest='atol', type=float, default=1e-5,
+                        help='Tolerance of the coordinate mapping of bsym (only used if bsym is installed), Defaults to 1e-5')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed of the symmetry operations applied to the candidates in the occupation key check - Defaults to 0')
+
+    global args
+    args = parser.parse_args()
+
+    inputs = args.inputs
+    if inputs is None:
+        inputs = sorted(glob.glob(os.path.normpath(f"{os.path.dirname(os.path.abspath(__file__))}/../examples") + "/*/input"))
+
+    cases = [(args.mixing, np.array(args.sc_matrix, dtype='float64').reshape(3,3)),
+             (args.multi_mixing, np.array(args.multi_sc_matrix, dtype='float64').reshape(3,3))]
+
+    if not HAS_BSYM:
+        print("bsym is not installed, the comparisons with bsym are skipped")
+
+    # identical base structures (the examples share one) are only checked once
+    checked = {}
+    failures = []
+    for input_path in inputs:
+        path = f"{input_path}/{args.base_path}"
+        with open(path, 'r') as f:
+            content = f.read()
+        if content in checked:
+            print(f"{path}: same structure as {checked[content]}, skipped")
+            continue
+        checked[content] = path
+
+        base_structure = Structure.from_file(path)
+        for mixing, supercell in cases:
+            failures += check_structure(path, base_structure, supercell, mixing)
+
+    if failures:
+        print(f"\n{len(failures)} checks failed:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nAll checks passed")
+
+
+def check_structure(path, base_structure, supercell, mixing):
+    # messages of the failed checks of one base structure, supercell and set of mixing species
+    structure = base_structure.make_supercell(supercell, in_place=False)
+    subset = list(structure.indices_from_symbol(mixing[0]))
+    mixing_nums = len(subset)
+    parent = (base_structure, supercell, args.symprec)
+    name = f"{path} {'-'.join(mixing)} {supercell.astype('int64').reshape(-1).tolist()}"
+
+    permutations = np.unique(parent_permutations(structure, subset, *parent), axis=0)
+    print(f"\n{name}: {mixing_nums} mixing sites, {len(permutations)} operations")
+
+    failures = []
+    try:
+        check_group(permutations)
+        if HAS_BSYM:
+            check_group_bsym(permutations, structure, subset)
+    except AssertionError as error:
+        # the candidates are only meaningful with the right symmetry
+        return [f"{name}: {error}"]
+
+    # the lat.in of the parent cell, as generate_candidates writes it
+    tmp_dir = tempfile.mkdtemp()
+    lattice_file = f"{tmp_dir}/lat.in"
+    with open(lattice_file, 'w') as f:
+        f.write(pmg_to_atat_str(base_structure, mixing))
+
+    weights, own_weights = canonical_weights(permutations, mixing_nums, len(mixing))
+    rng = np.random.default_rng(args.seed)
+
+    print("num_sub\tnative\tburnside\tresult")
+    try:
+        for num_sub in compositions(mixing_nums, len(mixing) - 1):
+            try:
+                native = check_enumeration(structure, num_sub, mixing_nums, mixing, parent, permutations, weights, own_weights)
+                check_occupation_keys(native, structure, supercell, mixing, permutations, lattice_file, rng)
+                print(f"{num_sub}\t{len(native)}\t{count_unique_compositions(permutations, site_counts(num_sub, mixing_nums, mixing))}\t\tok")
+            except AssertionError as error:
+                print(f"{num_sub}\t\t\t\tFAILED")
+                failures.append(f"{name} {num_sub}: {error}")
+    finally:
+        os.remove(lattice_file)
+        os.rmdir(tmp_dir)
+
+    return failures
+
+
+def check_group(permutations):
+    identity = np.arange(permutations.shape[1])
+    if not np.any(np.all(permutations == identity, axis=1)):
+        raise AssertionError("the permutations of the parent cell don't contain the identity")
+
+    # every product of two operations is an operation again
+    products = np.unique(permutations[:, permutations].reshape(-1, permutations.shape[1]), axis=0)
+    if len(products) != len(permutations) or np.any(products != permutations):
+        raise AssertionError("the permutations of the parent cell are not closed under composition")
+
+
+def check_group_bsym(permutations, structure, subset):
+    detected = np.unique(symmetry_permutations(structure, subset, args.atol), axis=0)
+    if len(detected) != len(permutations) or np.any(detected != permutations):
+        raise AssertionError(f"the {len(permutations)} permutations of the parent cell differ from the {len(detected)} ones detected by bsym")
+
+
+def check_enumeration(structure, num_sub, mixing_nums, mixing, parent, permutations, weights, own_weights):
+    # the native candidates as (candidates, mixing sites) array
+    counts = site_counts(num_sub, mixing_nums, mixing)
+    native = np.array(list(generate_candidate_configurations(structure, num_sub, mixing_nums, mixing, 'native', parent=parent)), dtype='uint8').reshape(-1, mixing_nums)
+
+    if np.any(np.stack([np.sum(native == species, axis=1) for species in range(len(counts))], axis=1) != counts):
+        raise AssertionError(f"candidates without the composition {counts}")
+
+    keys = canonical_keys(native, weights)
+    if np.any(keys != native.astype('float64') @ own_weights.T):
+        raise AssertionError("candidates that are not the smallest member of their orbit")
+    if len(np.unique(keys, axis=0)) != len(native):
+        raise AssertionError("symmetry equivalent candidates")
+
+    expected = count_unique_compositions(permutations, counts)
+    if len(native) != expected:
+        raise AssertionError(f"{len(native)} candidates, the Burnside count is {expected}")
+
+    if HAS_BSYM:
+        unique = np.array(list(generate_candidate_configurations(structure, num_sub, mixing_nums, mixing, 'unique', atol=args.atol)), dtype='uint8').reshape(-1, mixing_nums)
+        if unique.shape != native.shape or np.any(unique != native):
+            raise AssertionError(f"{len(native)} native candidates differ from the {len(unique)} of bsym")
+
+    return native
+
+
+def check_occupation_keys(native, structure, supercell, mixing, permutations, lattice_file, rng):
+    # every candidate and a copy moved by a random symmetry operation, both rendered as sqs.out
+    images = native[np.arange(len(native))[:, np.newaxis], permutations[rng.integers(len(permutations), size=len(native))]]
+    sqs_list = [text.splitlines() for text in iter_atat_str(structure, np.concatenate([native, images]), mixing, supercell)]
+
+    keys = occupation_keys({0: sqs_list}, lattice_file, args.symprec)[0]
+    if len(set(keys[:len(native)])) != len(native):
+        raise AssertionError("symmetry distinct candidates share an occupation key")
+    if keys[:len(native)] != keys[len(native):]:
+        raise AssertionError("symmetry equivalent candidates have different occupation keys")
+
+
+def compositions(mixing_nums, num_species):
+    # all numbers of substituted sites, a number for a binary mixing site and a tuple per replacement element otherwise
+    if num_species == 1:
+        return list(range(mixing_nums + 1))
+
+    ret = []
+    def extend(prefix, left):
+        if len(prefix) == num_species:
+            ret.append(tuple(prefix))
+            return
+        for num in range(left + 1):
+            extend(prefix + [num], left - num)
+    extend([], mixing_nums)
+    return ret
+
+
+if __name__ == '__main__':
+    main()
@@ -22,9 +22,11 @@ class Cluster:
         Use --> determines multiplicty, max node distance, number of nodes and the 
                 positions of the nodes of the cluster as instance variables:
                     self.multiplictiy, self.max_distance, self.num_nodes, self.nodes
+                the lines themselves are kept as self.data
 
         Returns => None
         """
+        self.data = data
         self.multiplicity = int(data[0])
         self.max_distance = float(data[1])
         self.num_nodes = int(data[2])
@@ -39,9 +41,10 @@ class Cluster:
             pass
 
 
-    def mean_distance(self):
+    def mean_distance(self, verify=False):
         """
-        Input: None
+        Input:
+        * verify - cross-check the distance with a plain python double sum (slow, for debugging)
 
         Use --> determine the mean distance of in the cluster in Angstrom
                 
@@ -66,9 +69,108 @@ class Cluster:
             return None
         else:
             cool = cool_distance(self.nodes)
-            lame = lame_distance(self.nodes)
-            if round(cool, 7) != round(lame, 7):
-                print('ERROR IN COOL DISTANCE!!!')
+            if verify:
+                lame = lame_distance(self.nodes)
+                if round(cool, 7) != round(lame, 7):
+                    print('ERROR IN COOL DISTANCE!!!')
 
             return cool*2/(self.num_nodes-1)/self.num_nodes
 
+
+
+class ClusterSet:
+
+    def __init__(self, clusters: list, verify: bool = False):
+        """
+        Input:
+        * clusters - list of Cluster objects in the order of clusters.out
+        * verify - cross-check the vectorized mean distances with Cluster.mean_distance (slow, for debugging)
+
+        Use --> stores the cluster geometry of a whole clusters.out as numpy arrays:
+                    self.multiplicities, self.max_distances, self.num_nodes - one entry per cluster
+                    self.nodes - cartesian node positions, padded with nan up to the largest cluster
+                    self.mean_distances - mean node distance, nan for clusters with less than two nodes
+
+        Returns => None
+        """
+        self.clusters = clusters
+        self.multiplicities = np.array([cluster.multiplicity for cluster in clusters], dtype='int64')
+        self.max_distances = np.array([cluster.max_distance for cluster in clusters], dtype='float64')
+        self.num_nodes = np.array([cluster.num_nodes for cluster in clusters], dtype='int64')
+
+        max_nodes = int(self.num_nodes.max()) if len(clusters) > 0 else 0
+        self.nodes = np.full((len(clusters), max_nodes, 3), np.nan, dtype='float64')
+        for idx, cluster in enumerate(clusters):
+            if cluster.num_nodes > 0:
+                self.nodes[idx, :cluster.num_nodes] = cluster.nodes
+
+        self.mean_distances = self._mean_distances()
+
+        if verify:
+            for idx, cluster in enumerate(clusters):
+                if cluster.num_nodes > 1 and self.mean_distances[idx] != cluster.mean_distance(verify=True):
+                    print('ERROR IN CLUSTER SET DISTANCE!!!')
+
+
+    def __len__(self):
+        return len(self.clusters)
+
+
+    def __getitem__(self, idx):
+        return self.clusters[idx]
+
+
+    def __iter__(self):
+        return iter(self.clusters)
+
+
+    def cutoff_mask(self, max_distances):
+        """
+        Input:
+        * max_distances - corrdump cutoffs for pairs, triplets, ... (-2, -3, ...)
+
+        Use --> selects the clusters corrdump would generate for smaller cutoffs, i.e. the clusters
+                whose longest pair is within the cutoff of their size. Empty and point clusters are always kept
+
+        Returns => boolean numpy array with one entry per cluster
+        """
+        cutoffs = np.array([float(dist) for dist in max_distances], dtype='float64')
+        mask = self.num_nodes < 2
+
+        for idx in np.flatnonzero(~mask):
+            if self.num_nodes[idx] - 2 < len(cutoffs):
+                mask[idx] = self.max_distances[idx] <= cutoffs[self.num_nodes[idx] - 2]
+
+        return mask
+
+
+    def random_correlations(self, point_correlation):
+        """
+        Input:
+        * point_correlation - correlation of the point cluster of a binary mixing site, i.e. x_2 - x_1
+
+        Use --> correlations of the random alloy; for a binary site the cluster function of every
+                node averages to the point correlation independently, so a cluster of n nodes gives point_correlation^n
+
+        Returns => numpy array with one random correlation per cluster
+        """
+        return np.array([float(point_correlation)**int(num_nodes) for num_nodes in self.num_nodes], dtype='float64')
+
+
+    def _mean_distances(self):
+        # clusters of the same size are handled together, so no padding enters the sums
+        mean_distances = np.full(len(self.clusters), np.nan, dtype='float64')
+
+        for num_nodes in np.unique(self.num_nodes):
+            if num_nodes < 2:
+                continue
+            idx = np.flatnonzero(self.num_nodes == num_nodes)
+            x = self.nodes[idx, :num_nodes]
+
+            r = np.power(x[:, np.newaxis, :, :] - x[:, :, np.newaxis, :], 2)
+            r = np.sqrt(np.sum(r, axis=3))
+            r = np.sum(np.tril(r), axis=(1, 2))
+
+            mean_distances[idx] = r*2/(num_nodes-1)/num_nodes
+
+        return mean_distances
@@ -1,5 +1,8 @@
 import os
-import sys
+import shutil
+import tempfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
@@ -8,14 +11,21 @@ import argparse
 import tools
 
 
+# defaults of --mcsqs_tolerance and --mcsqs_weight, the ones of mcsqs' -tol and -wr
+MCSQS_TOLERANCE = 1e-3
+MCSQS_WEIGHT = 1.0
+
+
 def main():
     parser = argparse.ArgumentParser("SQS-Candidate Evaluator")
 
     parser.add_argument('-i', '--input', dest='input', default='input',
                         help='The path where the input files are stored/generated - Defaults to \'input\' ')
     
-    parser.add_argument('--damping', dest='damping', default=2,
-                        help='The value of the damping constant - Defaults to 2')
+    parser.add_argument('--damping', dest='damping', nargs='+', type=float, default=[2],
+                        help='The value of the damping constant - Defaults to 2. If several values are given, errors.out gets one column per value')
+    parser.add_argument('--damping_range', dest='damping_range', nargs=3, type=float, default=None,
+                        help='Sweep the damping constant from START to STOP (inclusive) in steps of STEP, one errors.out column per value. Takes precedent over --damping')
     parser.add_argument('--calc_path', dest='calc_path', default='calc',
                         help='The path of the directory where the calculations are performed')
     parser.add_argument('--lattice_file', dest='lat_file', default='lat.in',
@@ -30,50 +40,262 @@ def main():
                         help='File to which the correlations are written - Defaults to \'tcorr.out\'')
     parser.add_argument('--error_file', dest='error_file', default='errors.out',
                         help='File to which the errors are written - Defaults to \'errors.out\'')
+    parser.add_argument('--verify_distances', dest='verify', action='store_true',
+                        help='Cross-check the vectorized cluster distances with a plain python implementation (slow, for debugging)')
+    parser.add_argument('--cache', dest='cache', action='store_true',
+                        help='Read and write binary \'.npy\' caches next to the correlation files, so later runs (e.g. damping sweeps) don\'t parse them again')
+    parser.add_argument('--block_size', dest='block_size', type=int, default=tools.CORR_BLOCK_SIZE,
+                        help=f'Number of sqs whose correlations are held in memory at once - Defaults to {tools.CORR_BLOCK_SIZE}')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of processes. With more than one, the folders are processed concurrently and split into shards of --block_size sqs - Defaults to 1')
+    parser.add_argument('--scorers', dest='scorers', nargs='+', default=['damped'], choices=list(SCORERS),
+                        help='Objectives written as columns of the error file, in the given order: \
+                            damped - sum of the damped absolute deviations | default \
+                            l2 - square root of the damped sum of the squared deviations \
+                            max - largest damped absolute deviation \
+                            mcsqs - approximation of the mcsqs objective, sum of the deviations minus the length up to which all clusters are matched. \
+                            damped, l2 and max get one column per damping constant')
+    parser.add_argument('--mcsqs_tolerance', dest='mcsqs_tol', type=float, default=MCSQS_TOLERANCE,
+                        help=f'mcsqs scorer: deviations from the random correlations below this count as matched, -tol of mcsqs - Defaults to {MCSQS_TOLERANCE}')
+    parser.add_argument('--mcsqs_weight', dest='mcsqs_weight', type=float, default=MCSQS_WEIGHT,
+                        help=f'mcsqs scorer: weight of the length up to which all clusters are matched, -wr of mcsqs - Defaults to {MCSQS_WEIGHT}')
+    parser.add_argument('--mirror', dest='mirror_bool', action='store_true',
+                        help='The folders of x > 0.5 were mirrored from x <= 0.5 by generate_correlations --mirror. Their errors are the same as the ones of the mirrored folders and are copied')
 
     global args
     args = parser.parse_args()
 
+    dampings = args.damping
+    if args.damping_range:
+        dampings = damping_sweep(*args.damping_range)
+
+    scorer_options = {'mcsqs': {'tolerance': args.mcsqs_tol, 'weight': args.mcsqs_weight}}
+
+    columns = error_columns(args.scorers, dampings)
+    if len(columns) > 1:
+        print("Error columns: " + " ".join([f"{idx}: {column}" for idx, column in enumerate(columns)]))
 
-    for folder in sorted(os.listdir(args.calc_path)):
-        calc_errors(calc_path       = f"{args.calc_path}/{folder}", 
-                    output_path     = args.error_file, 
-                    rcorr_file      = args.rcorr_file, 
-                    scorr_file      = args.scorr_file,
-                    lattice_file    = args.lat_file, 
-                    cluster_file    = args.clust_file, 
-                    damping         = float(args.damping)
-                    )
+    folders = sorted(os.listdir(args.calc_path))
+    mirrors = {}
+    if args.mirror_bool:
+        mirrors = tools.mirror_folders(args.calc_path, f"{args.calc_path}/{folders[0]}/{args.lat_file}", args.candidate_file)
+        folders = [folder for folder in folders if folder not in mirrors.values()]
 
+    if args.workers > 1:
+        calc_errors_parallel(calc_paths      = [f"{args.calc_path}/{folder}" for folder in folders], 
+                             output_path     = args.error_file, 
+                             rcorr_file      = args.rcorr_file, 
+                             scorr_file      = args.scorr_file,
+                             lattice_file    = args.lat_file, 
+                             cluster_file    = args.clust_file, 
+                             damping         = dampings,
+                             workers         = args.workers,
+                             scorers         = args.scorers,
+                             scorer_options  = scorer_options,
+                             verify          = args.verify,
+                             cache           = args.cache,
+                             shard_size      = args.block_size
+                             )
+    else:
+        for folder in folders:
+            calc_errors(calc_path       = f"{args.calc_path}/{folder}", 
+                        output_path     = args.error_file, 
+                        rcorr_file      = args.rcorr_file, 
+                        scorr_file      = args.scorr_file,
+                        lattice_file    = args.lat_file, 
+                        cluster_file    = args.clust_file, 
+                        damping         = dampings,
+                        scorers         = args.scorers,
+                        scorer_options  = scorer_options,
+                        verify          = args.verify,
+                        cache           = args.cache,
+                        block_size      = args.block_size
+                        )
 
-def calc_errors(calc_path:str, output_path:str, rcorr_file:str, scorr_file:str, lattice_file:str, cluster_file:str, damping):
-    # read in the pair correlations
-    rcorr, num_sqs, num_clus = tools.read_out_corr_file( f"{calc_path}/{rcorr_file}" )
-    scorr, _, _ = tools.read_out_corr_file( f"{calc_path}/{scorr_file}" )
+    # |(-s) - (-r)| = |s - r|, so the errors of a mirrored folder are exactly the ones of its source
+    for src, dst in mirrors.items():
+        shutil.copyfile(f"{args.calc_path}/{src}/{args.error_file}", f"{args.calc_path}/{dst}/{args.error_file}")
+        print(f" Errors of {args.calc_path}/{dst} copied from {args.calc_path}/{src}.\n")
 
+
+def calc_errors(calc_path:str, output_path:str, rcorr_file:str, scorr_file:str, lattice_file:str, cluster_file:str, damping, scorers=('damped',), scorer_options=None, verify=False, cache=False, block_size=tools.CORR_BLOCK_SIZE):
     # read in the cluster information
     coordinate_system = tools.get_coordinate_system( f"{calc_path}/{lattice_file}" )
-    clusters = tools.read_out_cluster_file( f"{calc_path}/{cluster_file}", coordinate_system )
+    clusters = tools.read_out_cluster_file( f"{calc_path}/{cluster_file}", coordinate_system, verify=verify )
+
+    weights = np.array([cluster_weights(clusters, value) for value in np.atleast_1d(damping)])
+
+    block_pairs = corr_block_pairs( f"{calc_path}/{scorr_file}", f"{calc_path}/{rcorr_file}", block_size=block_size, cache=cache )
+
+    num_sqs = write_error_file( f"{calc_path}/{output_path}", (score_errors(scorr, rcorr, weights, clusters.max_distances[1:], scorers, scorer_options) for scorr, rcorr in block_pairs) )
 
     print(f"\nNumber of sqs: \t\t{num_sqs}")
-    print(f"Number of clusters: \t{num_clus} (including the point cluster)\n")
-
-    error_list = []
-    num_backspace = 0
-
-    output_file = open(f"{calc_path}/{output_path}", 'w')
-    for i in range(num_sqs):
-        if i > 0:
-            num_backspace = int(np.floor(np.log10(i))+1)
-        sys.stdout.write(f"{"\b"*num_backspace}{i+1}")
-        sys.stdout.flush()
-        
-        error = np.sum([clusters[j].multiplicity/(clusters[j].num_nodes*clusters[j].mean_distance())**damping*abs(scorr[i,j]-rcorr[i,j]) for j in range(1, num_clus)]) #first cluster excluded since it is a point cluster
-        error_list.append(error)
-        output_file.write(str(error)+"\n")
+    print(f"Number of clusters: \t{len(clusters)} (including the point cluster)\n")
 
     print(f" Error functions corresponding to the input SQS where saved to \'{output_path}\'.\n")
-    return error_list
+    return num_sqs
+
+
+def calc_errors_parallel(calc_paths:list, output_path:str, rcorr_file:str, scorr_file:str, lattice_file:str, cluster_file:str, damping, workers, scorers=('damped',), scorer_options=None, verify=False, cache=False, shard_size=tools.CORR_BLOCK_SIZE):
+    # the correlation tables are memory-mapped .npy files, so all worker processes share the same pages instead of copies
+    tmp_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = []
+            for calc_path in calc_paths:
+                coordinate_system = tools.get_coordinate_system( f"{calc_path}/{lattice_file}" )
+                clusters = tools.read_out_cluster_file( f"{calc_path}/{cluster_file}", coordinate_system, verify=verify )
+                weights = np.array([cluster_weights(clusters, value) for value in np.atleast_1d(damping)])
+
+                scorr_table, num_sqs = shared_corr_table( f"{calc_path}/{scorr_file}", tmp_dir, cache )
+                rcorr_table, num_rnd = shared_corr_table( f"{calc_path}/{rcorr_file}", tmp_dir, cache )
+                if num_rnd != 1 and num_rnd != num_sqs:
+                    raise ValueError(f"{calc_path}/{rcorr_file} has {num_rnd} rows, expected 1 or {num_sqs}")
+
+                shards = [pool.submit(error_shard, scorr_table, rcorr_table, start, min(start + shard_size, num_sqs), weights, clusters.max_distances[1:], scorers, scorer_options) for start in range(0, num_sqs, shard_size)]
+                jobs.append((calc_path, len(clusters), num_sqs, shards))
+
+            # the shards are merged in order, so errors.out is the same as the one of calc_errors
+            for calc_path, num_clus, num_sqs, shards in jobs:
+                write_error_file( f"{calc_path}/{output_path}", (shard.result() for shard in shards) )
+
+                print(f"\nNumber of sqs: \t\t{num_sqs}")
+                print(f"Number of clusters: \t{num_clus} (including the point cluster)\n")
+                print(f" Error functions corresponding to the input SQS in {calc_path} where saved to \'{output_path}\'.\n")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def write_error_file(path, blocks):
+    # written to a temporary file first, so a failure while reading the correlations leaves an existing error file untouched
+    tmp_path = f"{path}.tmp"
+    num_sqs = 0
+    try:
+        with open(tmp_path, 'w') as output_file:
+            for errors in blocks:
+                output_file.write(format_errors(errors))
+                num_sqs += errors.shape[0]
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return num_sqs
+
+
+def shared_corr_table(path, tmp_dir, cache=False):
+    # path of a .npy version of the correlation file that the workers can memory-map, and the number of rows
+    if cache:
+        if tools.load_corr_cache(path) is None:
+            for _ in tools.read_out_corr_blocks(path, cache=True):
+                pass
+        arr = tools.load_corr_cache(path)
+        if arr is not None:
+            return tools.corr_cache_paths(path)[0], arr.shape[0]
+
+    # no cache or it couldn't be written next to the correlation file
+    arr, num_cand, _ = tools.read_out_corr_file(path, cache=False)
+    fd, table = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, arr)
+    return table, num_cand
+
+
+def error_shard(scorr_table, rcorr_table, start, stop, weights, max_distances, scorers, scorer_options=None):
+    scorr = np.load(scorr_table, mmap_mode='r')
+    rcorr = np.load(rcorr_table, mmap_mode='r')
+
+    random = rcorr if rcorr.shape[0] == 1 else rcorr[start:stop]
+    return score_errors(scorr[start:stop], random, weights, max_distances, scorers, scorer_options)
+
+
+def corr_block_pairs(scorr_path, rcorr_path, block_size=tools.CORR_BLOCK_SIZE, cache=False):
+    # the correlations are streamed in blocks of rows, so the memory doesn't grow with the number of sqs
+    rcorr_blocks = tools.read_out_corr_blocks( rcorr_path, block_size=block_size, cache=cache )
+    scorr_blocks = tools.read_out_corr_blocks( scorr_path, block_size=block_size, cache=cache )
+
+    # a random correlation file with a single row (e.g. generate_correlations --analytic_random) holds for all sqs
+    first_rcorr = next(rcorr_blocks)
+    if first_rcorr.shape[0] == 1:
+        rcorr_blocks.close()
+        return zip(scorr_blocks, itertools.repeat(first_rcorr))
+
+    return zip(scorr_blocks, itertools.chain([first_rcorr], rcorr_blocks), strict=True)
+
+
+def cluster_weights(clusters, damping):
+    # weight of every cluster in the error sum - first cluster excluded since it is a point cluster
+    # the power is taken cluster by cluster, numpy's vectorized power can differ from it in the last digit
+    size_distance = (clusters.num_nodes[1:]*clusters.mean_distances[1:]).tolist()
+    return clusters.multiplicities[1:]/np.array([dist**float(damping) for dist in size_distance], dtype='float64')
+
+
+def weighted_errors(scorr, rcorr, weights):
+    # sum of the weighted absolute correlation deviations for all sqs at once - one column per row of weights
+    return damped_score(np.abs(scorr[:, 1:] - rcorr[:, 1:]), np.atleast_2d(weights), None)
+
+
+def score_errors(scorr, rcorr, weights, max_distances, scorers, scorer_options=None):
+    # all objectives from a single evaluation of the deviations, the columns are in the order of scorers.
+    # scorer_options holds the keyword arguments of a scorer by its name, e.g. {'mcsqs': {'tolerance': 1e-3, 'weight': 1.0}}
+    scorer_options = scorer_options or {}
+    deviations = np.abs(scorr[:, 1:] - rcorr[:, 1:])
+    return np.column_stack([SCORERS[name](deviations, np.atleast_2d(weights), max_distances, **scorer_options.get(name, {})) for name in scorers])
+
+
+def error_columns(scorers, dampings):
+    # description of every column score_errors writes
+    columns = []
+    for name in scorers:
+        if name in DAMPED_SCORERS:
+            columns += [f"{name} (damping {damping})" for damping in dampings]
+        else:
+            columns.append(name)
+    return columns
+
+
+# every scorer gets the absolute deviations of the non-point clusters (one row per sqs), the cluster weights
+# (one row per damping constant) and the longest pair distance of every cluster, and returns one column per objective.
+# further parameters of a scorer are keyword arguments, filled from the scorer_options of score_errors
+def damped_score(deviations, weights, max_distances):
+    return np.column_stack([(row * deviations).sum(axis=1) for row in weights])
+
+
+def l2_score(deviations, weights, max_distances):
+    squared = deviations**2
+    return np.column_stack([np.sqrt((row * squared).sum(axis=1)) for row in weights])
+
+
+def max_score(deviations, weights, max_distances):
+    return np.column_stack([(row * deviations).max(axis=1, initial=0.0) for row in weights])
+
+
+def mcsqs_score(deviations, weights, max_distances, tolerance=MCSQS_TOLERANCE, weight=MCSQS_WEIGHT):
+    # -w*L + sum of the deviations, L being the longest pair distance up to which all clusters are matched (deviation below tolerance).
+    # an approximation of the mcsqs objective, not the exact one: the deviations of all clusters of clusters.out are summed unweighted
+    # and mcsqs' own cluster set and normalization aren't reproduced, so the values only follow the same form
+    order = np.argsort(max_distances, kind='stable')
+    unmatched = deviations[:, order] >= tolerance
+    first = np.where(unmatched.any(axis=1), unmatched.argmax(axis=1), len(order) - 1)
+    length = max_distances[order][first] if len(order) > 0 else np.zeros(deviations.shape[0])
+    return (deviations.sum(axis=1) - weight * length)[:, np.newaxis]
+
+
+SCORERS = {'damped': damped_score, 'l2': l2_score, 'max': max_score, 'mcsqs': mcsqs_score}
+DAMPED_SCORERS = ['damped', 'l2', 'max']
+
+
+def format_errors(errors):
+    # one line per sqs, one tab separated column per error
+    return "".join(["\t".join([f"{error}" for error in row]) + "\n" for row in errors.tolist()])
+
+
+def damping_sweep(start, stop, step):
+    if step <= 0 or stop < start:
+        raise argparse.ArgumentTypeError(f"Invalid damping range {start} {stop} {step}. Check -h for explanation of usage.")
+
+    num_steps = int(np.floor(round((stop - start)/step, 7))) + 1
+    return [round(start + idx*step, 7) for idx in range(num_steps)]
 
 
 # This is needed to choose the relative or absolute best SQS with one argument:
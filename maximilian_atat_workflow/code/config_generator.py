@@ -1,30 +1,249 @@
 import os
 import numpy as np
 
-import bsym.interface.pymatgen as ipmg
-from bsym.permutations import unique_permutations, flatten_list
-
 from atat_lattice_file import pmg_to_atat_str
+from symmetry import HAS_BSYM, configuration_space, require_bsym, symmetry_permutations, count_configurations, count_unique_compositions
 
+# only the unique and all modes use bsym directly, see symmetry.py
+if HAS_BSYM:
+    import bsym.interface.pymatgen as ipmg
+    from bsym import Configuration
+    from bsym.permutations import unique_permutations, flatten_list
 
-def generate_candidate_configurations(mix_str, num_sub, mixing_nums, mixing_sites, mode, atol=1e-5):
-    
+
+# upper bound of the (candidates x symmetry operations x sites) comparisons of the native enumerator held in memory at once
+CANONICAL_BATCH_ELEMENTS = 2**24
+# sites per integer key of the native enumerator, float64 holds integers up to 2^53 exactly
+CHUNK_BITS = 52
+# the random sampling gives up after this many draws per requested sample (few orbits left that are rarely hit)
+RANDOM_DRAW_FACTOR = 100
+
+
+def generate_candidate_configurations(mix_str, num_sub, mixing_nums, mixing_sites, mode, atol=1e-5, symmetry_cache=None, verify=False, samples=1000, seed=None, parent=None):
+    # generator over the configurations as uint8 occupation arrays (index into mixing_sites for every mixing site),
+    # the configurations are never all held in memory. num_sub is the number of sites of every species in mixing_sites[1:],
+    # a single number for a binary mixing site. With parent (parent structure, supercell matrix[, symprec]) the symmetry is built from the parent cell
     
-    site_distribution = { mixing_sites[0]: mixing_nums-num_sub, 
-                         mixing_sites[1]: num_sub} # If I wanna change it up so it can be used for more than binary ..
+    counts = site_counts( num_sub, mixing_nums, mixing_sites )
+    site_distribution = { species: count for species, count in zip( mixing_sites, counts ) }
     site_substitution_idx = list( mix_str.indices_from_symbol( mixing_sites[0] ) )
-    numeric_site_distribution, numeric_site_mapping = ipmg.parse_site_distribution( site_distribution )
     
     if mode == 'unique':
-        config_space = ipmg.configuration_space_from_structure( mix_str, subset=site_substitution_idx, atol=atol )
-        unique_configurations = config_space.unique_configurations( numeric_site_distribution )
-        configurations = [ [ mixing_sites[0] if mixing_sites[0] == numeric_site_mapping[element] else mixing_sites[1] for element in chem_config.tolist()] for chem_config in unique_configurations] # If I wanna change it up so it can be used for more than binary ..
+        # the numeric labels of bsym are the indices in mixing_sites
+        require_bsym( "the unique mode" )
+        numeric_site_distribution, numeric_site_mapping = ipmg.parse_site_distribution( site_distribution )
+        config_space = configuration_space( mix_str, subset=site_substitution_idx, atol=atol, cache_dir=symmetry_cache, parent=parent )
+        unique_configurations = iter_unique_configurations( config_space, numeric_site_distribution )
+        return ( np.array( chem_config, dtype='uint8' ) for chem_config in unique_configurations )
+
+    elif mode == 'native':
+        permutations = symmetry_permutations( mix_str, site_substitution_idx, atol=atol, cache_dir=symmetry_cache, parent=parent )
+        configurations = iter_canonical_configurations( permutations, len(site_substitution_idx), counts )
+        if verify:
+            configurations = verify_configurations( list( configurations ), mix_str, num_sub, mixing_nums, mixing_sites, atol )
+        return configurations
+
+    elif mode == 'random':
+        permutations = symmetry_permutations( mix_str, site_substitution_idx, atol=atol, cache_dir=symmetry_cache, parent=parent )
+        # one random stream per concentration, so the result doesn't depend on the order the concentrations are generated in
+        rng = np.random.default_rng( None if seed is None else [seed, *np.atleast_1d( num_sub ).tolist()] )
+        return iter_random_configurations( permutations, len(site_substitution_idx), counts, samples, rng )
 
     elif mode == 'all':
-        s = flatten_list( [ [ key ] * site_distribution[ key ] for key in site_distribution ] ) 
-        configurations = [ p for p in unique_permutations( s ) ]
+        require_bsym( "the all mode" )
+        # permuted in the (alphabetical) order of the species, then translated to the indices in mixing_sites
+        order = sorted( range( len( mixing_sites ) ), key=lambda idx: mixing_sites[idx] )
+        s = flatten_list( [ [ rank ] * counts[ idx ] for rank, idx in enumerate( order ) ] ) 
+        lookup = np.array( order, dtype='uint8' )
+        return ( lookup[ list( p ) ] for p in unique_permutations( s ) )
+
+
+def site_counts(num_sub, mixing_nums, mixing_sites):
+    # number of mixing sites of every species in mixing_sites
+    subs = [ int( num ) for num in np.atleast_1d( num_sub ) ]
+    if len( subs ) != len( mixing_sites ) - 1:
+        raise ValueError(f"{len( subs )} numbers of substituted sites given for the {len( mixing_sites ) - 1} substituting species {mixing_sites[1:]}")
+
+    counts = [ int( mixing_nums ) - sum( subs ) ] + subs
+    if min( counts ) < 0:
+        raise ValueError(f"The numbers of substituted sites {subs} exceed the {mixing_nums} mixing sites")
+    return counts
+
+
+def iter_canonical_configurations(permutations, num_sites, counts):
+    """
+    Input:
+    * permutations - permutations of the mixing sites under the symmetry operations, one row per operation
+    * num_sites - number of mixing sites
+    * counts - number of sites of every species
+
+    Use --> orderly enumeration: the configurations (index of the species on every site) are generated in lexicographic order
+            and a configuration is kept if no symmetry operation maps it onto a lexicographically smaller one.
+            This is the first member of every orbit bsym encounters, so the result is the one of unique_configurations
+            (same configurations, same order), without the set of visited permutations. The canonical-minimum checks
+            are done for batches of configurations and all operations at once
+
+    Returns => generator over uint8 arrays with one entry per mixing site
+    """
+    permutations = np.unique(permutations, axis=0)
+    weights, own_weights = canonical_weights(permutations, num_sites, len(counts))
+    batch_size = max(1, CANONICAL_BATCH_ELEMENTS // (len(permutations) * len(own_weights)))
+
+    total = count_configurations(counts)
+    if total >= 2**63:
+        raise ValueError(f"{total} configurations are too many to enumerate")
+
+    for start in range(0, total, batch_size):
+        configs = lexicographic_configurations(counts, start, min(start + batch_size, total))
+
+        # the permuted configurations as integers (one per chunk of sites), the first differing chunk decides which one is smaller
+        values = configs.astype('float64')
+        keys = np.stack([values @ chunk for chunk in weights], axis=2)
+        own = (values @ own_weights.T)[:, np.newaxis, :]
+
+        if len(own_weights) == 1:
+            smaller = keys[..., 0] < own[..., 0]
+        else:
+            differs = keys != own
+            first = differs.argmax(axis=2)[..., np.newaxis]
+            smaller = differs.any(axis=2) & (np.take_along_axis(keys, first, axis=2) < np.take_along_axis(np.broadcast_to(own, keys.shape), first, axis=2))[..., 0]
+
+        yield from configs[~smaller.any(axis=1)]
+
+
+def iter_random_configurations(permutations, num_sites, counts, samples, rng):
+    """
+    Input:
+    * permutations - permutations of the mixing sites under the symmetry operations, one row per operation
+    * num_sites - number of mixing sites
+    * counts - number of sites of every species
+    * samples - number of symmetry distinct configurations to draw
+    * rng - numpy random generator
+
+    Use --> draws random configurations and keeps the ones whose canonical key (lexicographically smallest symmetry
+            equivalent) was not drawn before. Only the keys of the kept configurations are held in memory.
+            If samples covers all symmetry unique configurations, they are enumerated instead
+
+    Returns => generator over uint8 arrays with one entry per mixing site, in the order they were drawn
+    """
+    permutations = np.unique(permutations, axis=0)
+    if samples >= count_unique_compositions(permutations, counts):
+        yield from iter_canonical_configurations(permutations, num_sites, counts)
+        return
+
+    weights, own_weights = canonical_weights(permutations, num_sites, len(counts))
+    batch_size = max(1, min(samples, CANONICAL_BATCH_ELEMENTS // (len(permutations) * len(own_weights))))
+    base = np.repeat(np.arange(len(counts), dtype='uint8'), counts)
+
+    seen = set()
+    for _ in range(0, RANDOM_DRAW_FACTOR * samples, batch_size):
+        configs = rng.permuted(np.tile(base, (batch_size, 1)), axis=1)
+        for config, key in zip(configs, canonical_keys(configs, weights)):
+            key = key.tobytes()
+            if key in seen:
+                continue
+            seen.add(key)
+            yield config
+            if len(seen) == samples:
+                return
+
+    print(f"Only {len(seen)} of {samples} symmetry distinct configurations found with {counts} sites per species after {RANDOM_DRAW_FACTOR * samples} draws")
+
+
+def canonical_keys(configs, weights):
+    # key of the lexicographically smallest symmetry equivalent of every configuration, one float64 integer per chunk of sites.
+    # chunk by chunk, only the operations that reach the minimum of the previous chunks stay in the race
+    values = configs.astype('float64')
+    keys = np.stack([values @ chunk for chunk in weights], axis=2)
+
+    minimal = np.ones(keys.shape[:2], dtype='bool')
+    canonical = np.empty((keys.shape[0], keys.shape[2]), dtype='float64')
+    for chunk in range(keys.shape[2]):
+        canonical[:, chunk] = np.where(minimal, keys[..., chunk], np.inf).min(axis=1)
+        minimal &= keys[..., chunk] == canonical[:, chunk, np.newaxis]
+    return canonical
+
+
+def lexicographic_configurations(counts, start, stop):
+    # configurations number start ... stop-1 (in lexicographic order) with counts[s] sites of species s, by unranking:
+    # on every site the configurations with the lower species come first, there are multinomial(remaining counts) of each
+    multinomials = multinomial_table(counts)
+    num_species = len(counts)
+
+    ranks = np.arange(start, stop, dtype='int64')
+    remaining = np.tile(np.array(counts, dtype='int64'), (len(ranks), 1))
+    configs = np.zeros((len(ranks), sum(counts)), dtype='uint8')
+
+    for site in range(configs.shape[1]):
+        undecided = np.ones(len(ranks), dtype='bool')
+        for species in range(num_species - 1):
+            left = remaining.copy()
+            left[:, species] -= 1
+            with_species = np.where(left[:, species] >= 0, multinomials[tuple(np.maximum(left, 0).T)], 0)
+
+            here = undecided & (ranks < with_species)
+            configs[here, site] = species
+            remaining[here, species] -= 1
+            ranks -= np.where(undecided & ~here, with_species, 0)
+            undecided &= ~here
+
+        configs[undecided, site] = num_species - 1
+        remaining[undecided, num_species - 1] -= 1
+
+    return configs
+
+
+def multinomial_table(counts):
+    # number of arrangements of every combination of remaining counts (0 ... counts[s] sites of species s)
+    table = np.zeros(tuple(count + 1 for count in counts), dtype='int64')
+    for remaining in np.ndindex(table.shape):
+        table[remaining] = count_configurations(remaining)
+    return table
+
+
+def canonical_weights(permutations, num_sites, num_species=2):
+    # a configuration read in the order of a permutation is the number sum_j config[perm[j]] num_species^(chunk end - 1 - j), split
+    # into chunks of sites so the float64 matrix products stay exact (below 2^CHUNK_BITS). Returns one (sites, operations) matrix
+    # per chunk and the (chunks, sites) weights of the unpermuted configuration
+    base = max(num_species, 2)
+    chunk_sites = 1
+    while base**(chunk_sites + 1) <= 2**CHUNK_BITS:
+        chunk_sites += 1
+
+    position = np.argsort(permutations, axis=1)
+    chunks = [(start, min(start + chunk_sites, num_sites)) for start in range(0, max(num_sites, 1), chunk_sites)]
+
+    weights = [np.where((position >= start) & (position < stop), float(base)**(stop - 1 - position), 0.0).T for start, stop in chunks]
+    sites = np.arange(num_sites)
+    own_weights = np.array([np.where((sites >= start) & (sites < stop), float(base)**(stop - 1 - sites), 0.0) for start, stop in chunks])
+    return weights, own_weights
+
+
+def verify_configurations(configurations, mix_str, num_sub, mixing_nums, mixing_sites, atol):
+    # cross-check of the native enumerator with bsym (slow, for debugging)
+    reference = [ config.tolist() for config in generate_candidate_configurations( mix_str, num_sub, mixing_nums, mixing_sites, 'unique', atol=atol ) ]
+    if reference != [ config.tolist() for config in configurations ]:
+        raise ValueError(f"The native enumeration ({len(configurations)} configurations) differs from bsym ({len(reference)} configurations)")
+    print(f"The native enumeration agrees with bsym ({len(configurations)} configurations)")
+    return iter( configurations )
+
+
+def iter_unique_configurations(config_space, site_distribution):
+    # same configurations in the same order as config_space.unique_configurations, but yielded as soon as they are found.
+    # the permutations come in lexicographic order, so an equivalent permutation can be forgotten once it was passed
+    s = flatten_list( [ [ key ] * site_distribution[ key ] for key in site_distribution ] )
+    seen = set()
+
+    for permutation in unique_permutations( s ):
+        perm_as_bytes = Configuration.tuple_to_bytes( permutation )
+        if perm_as_bytes in seen:
+            seen.discard( perm_as_bytes )
+            continue
 
-    return configurations
+        config = Configuration.from_tuple( permutation )
+        seen.update( config.get_byte_equivalents( config_space.symmetry_group ) )
+        seen.discard( perm_as_bytes )
+        yield permutation
 
 
 def generate_base_lat_in(input_path, structure, mixing, supercell=np.eye(3)):
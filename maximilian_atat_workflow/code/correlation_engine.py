@@ -0,0 +1,242 @@
+import itertools
+
+import numpy as np
+import spglib
+
+from tools import parse_lattice_lines, read_lattice_file, read_out_cluster_file
+
+
+""" Native replacement for the correlation part of corrdump (binary mixing sites only)
+
+    The cluster orbits of clusters.out are generated with the space group of lat.in and mapped
+    onto the mixing sites of the supercell once. The correlations of all candidates are then
+    averages of products of the occupation variables (-1 for the first, +1 for the second species
+    of a site), evaluated as batched numpy products.
+"""
+
+class CorrelationEngine:
+
+    def __init__(self, lattice_file: str, cluster_file: str, sqs: list, symprec: float = 1e-3, tolerance: float = 1e-3):
+        """
+        Input:
+        * lattice_file - path of the lat.in
+        * cluster_file - path of the clusters.out written by corrdump for the lat.in
+        * sqs - lines of one candidate of sqs.out, all candidates are expected to share its geometry
+        * symprec - tolerance of the space group detection of the lat.in
+        * tolerance - tolerance (in fractional coordinates) when mapping points onto lattice sites
+
+        Use --> maps every cluster of every orbit in clusters.out onto the mixing sites of the supercell:
+                    self.orbit_sites - one (number of clusters in the supercell, number of nodes) array of mixing site indices per orbit
+                    self.mixing_atoms - atom indices of the mixing sites in the candidates
+                    self.mixing_species - the two possible species of every mixing site
+
+        Returns => None
+        """
+        self.tolerance = tolerance
+
+        coordinate_system, cell, positions, species = read_lattice_file(lattice_file)
+        self.clusters = read_out_cluster_file(cluster_file, coordinate_system)
+
+        self.inv_cell = np.linalg.inv(cell)
+        self.site_frac = positions @ self.inv_cell
+        self.site_species = species
+
+        if any(len(site) > 2 for site in species):
+            raise ValueError("The native correlation engine only supports binary mixing sites")
+
+        # space group of the parent lattice, sites with different species are distinguished
+        labels = sorted(set([",".join(site) for site in species]))
+        numbers = [labels.index(",".join(site)) for site in species]
+        symmetry = spglib.get_symmetry((cell @ coordinate_system, self.site_frac, numbers), symprec=symprec)
+        self.rotations = symmetry['rotations']
+        self.translations = symmetry['translations']
+
+        # supercell of the candidates in units of the parent cell
+        sqs_coordinate_system, sqs_cell, sqs_positions, sqs_species = parse_lattice_lines(sqs)
+        # corrdump doesn't rotate the candidates onto the axes of the lat.in either, it strains them and maps the atoms onto
+        # the nearest lattice sites, so a rotated lat.in (same lattice, other cartesian axes) is refused instead of reinterpreted
+        if not np.allclose(sqs_coordinate_system, coordinate_system, atol=1e-5):
+            raise ValueError("The candidates and the lat.in don't share the same coordinate system, write the lat.in with the axes of the candidates")
+
+        supercell = sqs_cell @ self.inv_cell
+        if not np.allclose(supercell, np.round(supercell), atol=tolerance):
+            raise ValueError("The cell of the candidates is no supercell of the lat.in")
+        self.supercell = np.round(supercell).astype('int64')
+        self.inv_supercell = np.linalg.inv(self.supercell)
+
+        # mixing atoms of the candidates and their (site, cell) position in the parent lattice
+        sites, cells = self.map_points(sqs_positions @ self.inv_cell)
+        self.mixing_atoms = np.array([idx for idx, site in enumerate(sites) if len(species[site]) > 1], dtype='int64')
+        self.mixing_species = [species[sites[idx]] for idx in self.mixing_atoms]
+        self.reference = [line.rsplit(maxsplit=1)[0] for line in self.structure_lines(sqs)]
+
+        self.translation_vectors = self.supercell_translations()
+        self.site_lookup = self.build_site_lookup(sites[self.mixing_atoms], cells[self.mixing_atoms])
+
+        self.orbit_sites = [self.map_orbit(idx) for idx in range(len(self.clusters))]
+
+
+    @staticmethod
+    def structure_lines(sqs):
+        return [line for line in sqs if line.strip() != '' and line.strip() != 'end']
+
+
+    def map_points(self, frac):
+        # lattice site and cell of every point (fractional coordinates of the parent lattice)
+        diff = frac[:, np.newaxis, :] - self.site_frac[np.newaxis, :, :]
+        err = np.max(np.abs(diff - np.round(diff)), axis=2)
+        sites = np.argmin(err, axis=1)
+
+        if np.any(err[np.arange(len(sites)), sites] > self.tolerance):
+            raise ValueError("Point does not lie on a site of the lat.in")
+
+        cells = np.round(diff[np.arange(len(sites)), sites]).astype('int64')
+        return sites, cells
+
+
+    def reduce_cells(self, cells):
+        # bring cell vectors back into the supercell
+        shift = np.floor(cells @ self.inv_supercell + 1e-8)
+        return cells - np.round(shift @ self.supercell).astype('int64')
+
+
+    def supercell_translations(self):
+        # all parent lattice vectors inside the supercell
+        corners = np.array([np.sum([row for row, use in zip(self.supercell, comb) if use], axis=0) if any(comb) else np.zeros(3) for comb in itertools.product([0, 1], repeat=3)])
+        box = [range(int(corners[:, ax].min()), int(corners[:, ax].max()) + 1) for ax in range(3)]
+
+        candidates = np.array(list(itertools.product(*box)), dtype='int64')
+        frac = candidates @ self.inv_supercell
+        inside = np.all((frac > -1e-8) & (frac < 1 - 1e-8), axis=1)
+        translations = candidates[inside]
+
+        if len(translations) != int(round(abs(np.linalg.det(self.supercell)))):
+            raise ValueError("Could not determine the translations of the supercell")
+        return translations
+
+
+    def build_site_lookup(self, sites, cells):
+        # dense table (site, reduced cell) -> index of the mixing site in the occupation vectors
+        cells = self.reduce_cells(cells)
+        all_cells = self.reduce_cells(self.translation_vectors)
+        self.cell_offset = all_cells.min(axis=0)
+        shape = (len(self.site_frac),) + tuple(all_cells.max(axis=0) - self.cell_offset + 1)
+
+        lookup = np.full(shape, -1, dtype='int64')
+        lookup[(sites,) + tuple((cells - self.cell_offset).T)] = np.arange(len(sites))
+        if np.sum(lookup != -1) != len(sites):
+            raise ValueError("Two mixing atoms of the candidates occupy the same site")
+
+        if np.sum(lookup != -1) != len(self.translation_vectors) * sum([len(site) > 1 for site in self.site_species]):
+            raise ValueError("The mixing sites of the candidates don't cover the supercell")
+        return lookup
+
+
+    def map_orbit(self, idx):
+        cluster = self.clusters[idx]
+        if cluster.num_nodes == 0:
+            return np.zeros((1, 0), dtype='int64')
+
+        nodes = np.array([line.split()[:5] for line in cluster.data[3:3 + cluster.num_nodes]], dtype='float64')
+        if np.any(nodes[:, 3:] != 0):
+            raise ValueError("The native correlation engine only supports binary cluster functions")
+        frac = nodes[:, :3] @ self.inv_cell
+
+        # all symmetry equivalent clusters of the parent lattice, one per lattice translation class
+        orbit = {}
+        for rotation, translation in zip(self.rotations, self.translations):
+            sites, cells = self.map_points(frac @ rotation.T + translation)
+            orbit.setdefault(self.canonical_cluster(sites, cells), (sites, cells))
+
+        if len(orbit) != cluster.multiplicity:
+            raise ValueError(f"Orbit of cluster {idx} has {len(orbit)} members, clusters.out states a multiplicity of {cluster.multiplicity}")
+
+        # every member of the orbit translated through the supercell
+        orbit_sites = []
+        for sites, cells in orbit.values():
+            shifted = self.reduce_cells(cells[np.newaxis, :, :] + self.translation_vectors[:, np.newaxis, :]) - self.cell_offset
+            orbit_sites.append(self.site_lookup[(sites[np.newaxis, :],) + tuple(np.moveaxis(shifted, 2, 0))])
+
+        return np.concatenate(orbit_sites, axis=0)
+
+
+    @staticmethod
+    def canonical_cluster(sites, cells):
+        # representation of a cluster that is the same for all of its lattice translations and node orders
+        keys = []
+        for anchor in np.flatnonzero(sites == sites.min()):
+            points = sorted(zip(sites.tolist(), map(tuple, (cells - cells[anchor]).tolist())))
+            keys.append(tuple(points))
+        return min(keys)
+
+
+    def occupations(self, sqs_list):
+        """
+        Input:
+        * sqs_list - candidates (lists of lines) sharing the geometry of the sqs the engine was built with
+
+        Use --> occupation variables of the mixing sites, -1 for the first and +1 for the second species of a site
+
+        Returns => int8 array of shape (number of candidates, number of mixing sites)
+        """
+        species = []
+        for sqs in sqs_list:
+            lines = self.structure_lines(sqs)
+            if len(lines) != len(self.reference) or any(line.rsplit(maxsplit=1)[0] != ref for line, ref in zip(lines, self.reference)):
+                raise ValueError("All candidates have to share the same geometry for the native correlation engine")
+            species.append([lines[6 + atom].rsplit(maxsplit=1)[1] for atom in self.mixing_atoms])
+
+        species = np.array(species, dtype='str').reshape(-1, len(self.mixing_atoms))
+        first = np.array([site[0] for site in self.mixing_species])
+        second = np.array([site[1] for site in self.mixing_species])
+
+        sigma = np.where(species == second, 1, -1).astype('int8')
+        if np.any((species != first) & (species != second)):
+            raise ValueError("Candidates contain species that are not allowed on their mixing sites")
+
+        return sigma
+
+
+    def store_occupations(self, store, start=0, stop=None):
+        """
+        Input:
+        * store - CandidateStore of candidates sharing the geometry of the sqs the engine was built with
+        * start, stop - range of candidates
+
+        Use --> occupation variables straight from the packed bits of the store, without rendering the candidates
+
+        Returns => int8 array of shape (number of candidates, number of mixing sites), same as self.occupations
+        """
+        columns = {atom: col for col, atom in enumerate(store.mixing_atoms.tolist())}
+        if any(atom not in columns for atom in self.mixing_atoms.tolist()):
+            raise ValueError("The mixing sites of the store and of the lat.in don't match")
+
+        # +1 where the second species of the lat.in site sits
+        second = np.array([store.species.index(site[1]) for site in self.mixing_species], dtype='uint8')
+        bits = store.occupations(start, stop)[:, [columns[atom] for atom in self.mixing_atoms.tolist()]]
+        return np.where(bits == second, 1, -1).astype('int8')
+
+
+    def correlations(self, sigma):
+        """
+        Input:
+        * sigma - occupation variables as returned by self.occupations
+
+        Use --> correlation of every cluster of clusters.out for all candidates at once
+
+        Returns => float64 array of shape (number of candidates, number of clusters)
+        """
+        corr = np.empty((sigma.shape[0], len(self.orbit_sites)), dtype='float64')
+
+        for col, sites in enumerate(self.orbit_sites):
+            prod = np.ones((sigma.shape[0], sites.shape[0]), dtype='int8')
+            for node in range(sites.shape[1]):
+                prod *= sigma[:, sites[:, node]]
+            corr[:, col] = prod.sum(axis=1, dtype='int64')/sites.shape[0]
+
+        return corr
+
+
+def format_correlations(corr):
+    # same layout as the corrdump output
+    return "".join(["".join([f"{value:.5f}\t" for value in row]) + "\n" for row in corr.tolist()])
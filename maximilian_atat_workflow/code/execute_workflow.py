@@ -2,6 +2,7 @@ import os
 import sys
 import argparse
 import shutil
+import subprocess
 import numpy as np
 
 from pymatgen.core.structure import Structure
@@ -33,7 +34,9 @@ def main():
     
     # candidate generation
     parser.add_argument('-m', '--mode', dest='mode_var', default='unique',
-                        help='The flag determining the mode in which the candidate generation operates to generate the candidates. Options: unique; all; unique')
+                        help='The flag determining the mode in which the candidate generation operates to generate the candidates. Options: unique; native; random; gensqs; all')
+    parser.add_argument('--samples', dest='samples', default=1000,
+                        help='Number of candidates per concentration in the random and gensqs modes - Defaults to 1000')
     parser.add_argument('-lim', '--limited', dest='lim_bool', action='store_true',
                         help='Limit SQS candidate generation to x <= 0.5')
     parser.add_argument('-mix', '--mixing_sites', dest='mixing', nargs=2,
@@ -41,21 +44,52 @@ def main():
     parser.add_argument('--super_cell_long', nargs=9, dest='sc_matrix', default=[1,0,0,0,1,0,0,0,1],
                         help='Supercell matrix, defaults to None. If given takes precedent over -sc')
     parser.add_argument('--tolerance', dest='atol', default=1e-5,
-                        help='Tolerance when checking symmetry, Defaults to 1e-5')
+                        help='Tolerance of the coordinate mapping of bsym when the symmetry is detected on the supercell, Defaults to 1e-5')
+    parser.add_argument('--symprec', dest='symprec', default=1e-2,
+                        help='Tolerance (in Angstrom) of the symmetry detection of the base structure, from which the symmetry of the supercell is built - Defaults to 1e-2')
+    parser.add_argument('--dry_run', dest='dry_bool', action='store_true',
+                        help='Only print the number of candidates per concentration and estimates of the file sizes, memory and time of the stages, then stop')
+    parser.add_argument('--binary_candidates', dest='binary_bool', action='store_true',
+                        help='Store the candidates in binary \'sqs.out.npz\' files instead of the sqs.out text, which is only rendered when corrdump needs it')
     
     #correlation generation
     parser.add_argument('-d', '--distance_file', dest='distance_file', default='distance.dat',
                         help='File containing the max-distances for the clusters. Path relative to input path. Defaults to distance.dat')
+    parser.add_argument('--analytic_random', dest='analytic_bool', action='store_true',
+                        help='Compute the random correlations from the concentration instead of a second corrdump run (binary mixing site only)')
+    parser.add_argument('--reuse_correlations', dest='reuse_bool', action='store_true',
+                        help='Compute the correlations once for the envelope (column wise maximum) of all rows in the distance file and select the clusters of every row from it')
+    parser.add_argument('--engine', dest='engine', default='corrdump',
+                        help='Engine computing the correlations: corrdump or native (python, binary mixing site only) - Defaults to corrdump')
+    parser.add_argument('--mirror', dest='mirror_bool', action='store_true',
+                        help='Generate the candidates, correlations and errors only for x <= 0.5 and derive the ones of x > 0.5 by exchanging the species (binary mixing site only). Ignored with -lim')
 
     # compare correlations
-    parser.add_argument('--damping', dest='damping', default=2,
-                        help='The value of the damping constant - Defaults to 2')
+    parser.add_argument('--damping', dest='damping', nargs='+', default=['2'],
+                        help='The value of the damping constant - Defaults to 2. Several values give one error column per value')
+    parser.add_argument('--damping_range', dest='damping_range', nargs=3, default=None,
+                        help='Sweep the damping constant from START to STOP (inclusive) in steps of STEP. Takes precedent over --damping')
+    parser.add_argument('--scorers', dest='scorers', nargs='+', default=['damped'],
+                        help='Objectives written as columns of the error file: damped, l2, max, mcsqs - Defaults to damped')
+    parser.add_argument('--mcsqs_tolerance', dest='mcsqs_tol', default=1e-3,
+                        help='mcsqs scorer: deviations below this count as matched, -tol of mcsqs - Defaults to 1e-3')
+    parser.add_argument('--mcsqs_weight', dest='mcsqs_weight', default=1.0,
+                        help='mcsqs scorer: weight of the length up to which all clusters are matched, -wr of mcsqs - Defaults to 1.0')
+    parser.add_argument('--cache_correlations', dest='cache_bool', action='store_true',
+                        help='Keep binary \'.npy\' caches next to the correlation files, so the error computation and the selection parse them only once')
+    parser.add_argument('--workers', dest='workers', default=1,
+                        help='Number of processes generating the candidates and computing the errors - Defaults to 1')
 
     # select best
     parser.add_argument('-b', '--num_best', dest='num_best', default=3,
                         help='Number of SQS selected - Defaults to 3')
     parser.add_argument('-w', '--write_unique', dest='write_unique', action='store_false',
                         help='saves the subset of sqs that are within the lowest errors and sym unique to \'\"calc_path\"/unique_\"candidate_file\"\' and \'\"calc_path\"/unique_\"error_file\"\'')
+    parser.add_argument('--error_column', dest='error_column', nargs='+', default=['0'],
+                        help='Error column (i.e. damping constant of a sweep or scorer) used to select the best sqs. Several columns rank lexicographically - Defaults to 0')
+    parser.add_argument('--select_from_correlations', dest='stream_bool', action='store_true',
+                        help='Skip writing the error files and select the lowest error sqs directly from the correlations with a pruned partial sum. \
+                            Supports only the damped scorer with a single --damping value, error column 0. With --mirror the mirrored correlations are read directly')
     parser.add_argument('--num_errors', dest='num_err', default=5,
                         help='Number of Errors considered when checking symmetry - Defaults to 3')
     
@@ -75,61 +109,117 @@ def main():
     parser.add_argument('--precision', dest='prec', default=7,
                         help='Precision for float comparison - Defaults to 7')
     parser.add_argument('--seed', dest='seed', default=None,
-                        help='randomness seed. default taken from sys parameters')
+                        help='randomness seed, also of the random candidate mode. default taken from sys parameters')
     
     global args
     args = parser.parse_args()
 
+    # the selection from the correlations computes a single damped error, the other objectives need the error files
+    if args.stream_bool:
+        if args.scorers != ['damped'] or len(args.damping) != 1 or args.damping_range is not None or args.error_column != ['0']:
+            parser.error("--select_from_correlations supports only --scorers damped with a single --damping value and --error_column 0")
+
     max_distances = read_in_max_distance(f"{args.input}/{args.distance_file}")
 
+    if args.dry_bool:
+        candidate_gen(dry_run=True)
+        return
+
     if not os.path.exists(args.path):
         os.makedirs(args.path)
 
-    candidate_gen()
+    candidate_gen(max_distances=max_distances)
+
+    analytic = []
+    if args.analytic_bool:
+        analytic = ['--analytic_random']
+    mirror = []
+    if args.mirror_bool and not args.lim_bool:
+        mirror = ['--mirror']
+
+    # the clusters of every row are a subset of the ones of the envelope, so the correlations are only computed once
+    if args.reuse_bool:
+        envelope = envelope_distances(max_distances)
+        run_script(args.correlation_gen, ['--input', args.input, '--max_distances', *envelope, *analytic, *mirror, '--engine', args.engine, '--calc_path', f"{args.path}/tmp"])
     
     for distance in max_distances:
         calc_path = f"{args.path}/{args.path}_{"_".join(distance)}"
         shutil.copytree(f"{args.path}/tmp", calc_path)
 
         #generate correlations
-        os.system(f"python {args.bin_dir}/{args.correlation_gen} --input {args.input} --max_distances {" ".join(distance)} --calc_path {calc_path}")
+        if args.reuse_bool:
+            run_script(args.correlation_gen, ['--input', args.input, '--max_distances', *distance, '--reuse_envelope', '--calc_path', calc_path])
+        else:
+            run_script(args.correlation_gen, ['--input', args.input, '--max_distances', *distance, *analytic, *mirror, '--engine', args.engine, '--calc_path', calc_path])
+
+        cache = []
+        if args.cache_bool:
+            cache = ['--cache']
 
         #calculate the errors
-        os.system(f"python {args.bin_dir}/{args.candidate_compare} --input {args.input} --damping {args.damping} --calc_path {calc_path}")
+        damping = ['--damping', *args.damping]
+        if args.damping_range:
+            damping = ['--damping_range', *args.damping_range]
+        stream = []
+        if args.stream_bool:
+            stream = ['--from_correlations', '--damping', args.damping[0], *cache]
+        else:
+            run_script(args.candidate_compare, ['--input', args.input, *damping, *mirror, '--scorers', *args.scorers, '--mcsqs_tolerance', args.mcsqs_tol, '--mcsqs_weight', args.mcsqs_weight, '--workers', args.workers, *cache, '--calc_path', calc_path])
 
         # select the best sqs
-        write_unique = ""
+        write_unique = []
         if args.match_bool or args.write_unique:
-            write_unique = " --write_unique "
-        os.system(f"python {args.bin_dir}/{args.select_best} --input {args.input} --num_best {args.num_best}{write_unique}--num_errors {args.num_err} --calc_path {calc_path}")
+            write_unique = ['--write_unique']
+        run_script(args.select_best, ['--input', args.input, '--num_best', args.num_best, *write_unique, *stream, '--num_errors', args.num_err, '--error_column', *args.error_column, '--symprec', args.symprec, '--calc_path', calc_path])
         
     #remove temporary candidate creation dir
     shutil.rmtree(f"{args.path}/tmp")
 
     # writing the output
-    match = ""
-    limited = ""
+    match = []
+    limited = []
     if args.match_bool:
-        match = " --perform_match "
+        match = ['--perform_match']
     if args.lim_bool:
-        limited = " --limited "
+        limited = ['--limited']
 
-    print(f"python {args.bin_dir}/{args.output_gen} --input {args.input} --num_best {args.num_best} --output_dir {args.output_dir}{match}--mixing {" ".join(args.mixing)}{limited}--path {args.path}")
-    os.system(f"python {args.bin_dir}/{args.output_gen} --input {args.input} --num_best {args.num_best} --output_dir {args.output_dir}{match}--mixing {" ".join(args.mixing)}{limited}--path {args.path}")
+    run_script(args.output_gen, ['--input', args.input, '--num_best', args.num_best, '--output_dir', args.output_dir, *match, '--mixing', *args.mixing, *limited, '--path', args.path], verbose=True)
     
 
-def candidate_gen():
+def run_script(script, arguments, verbose=False):
+    # every stage is a script of the bin directory, the workflow stops if one of them fails
+    command = [sys.executable, f"{args.bin_dir}/{script}"] + [str(arg) for arg in arguments]
+    if verbose:
+        print(" ".join(command))
+    subprocess.run(command, check=True)
+
+
+def candidate_gen(dry_run=False, max_distances=None):
     # generate the candidate structures in a temporary directory
-    if not os.path.exists(f"{args.path}/tmp"):
+    if not dry_run and not os.path.exists(f"{args.path}/tmp"):
         os.makedirs(f"{args.path}/tmp")
 
     # read out the supercell configurations
     supercell = np.array(args.sc_matrix, dtype='float64').reshape(3,3)
 
-    mixing_nums = determine_mixing_nums(f"{args.input}/{args.base_path}", args.mixing, supercell, True)#args.lim_bool)
+    options = []
+    if args.binary_bool:
+        options.append('--binary')
+    if dry_run:
+        options.append('--dry_run')
+    if args.mode_var in ['random', 'gensqs']:
+        options += ['--samples', args.samples]
+        if args.seed is not None:
+            options += ['--seed', args.seed]
+    # the annealing minimizes the error of the envelope clusters (first damping constant)
+    if args.mode_var == 'gensqs' and max_distances:
+        options += ['--max_distances', *envelope_distances(max_distances), '--damping', args.damping[0]]
+
+    mixing_nums = determine_mixing_nums(f"{args.input}/{args.base_path}", args.mixing, supercell, args.lim_bool or args.mirror_bool)
 
-    for conc in range(mixing_nums + 1):
-        os.system(f"python {args.bin_dir}/{args.candidate_gen} --input {args.input} --mode {args.mode_var} --concentration {conc} --mixing_sites {" ".join(args.mixing)} --super_cell_long {" ".join([str(comp) for comp in supercell.reshape(1,-1).tolist()[0]])} --calc_path {args.path}/tmp --tolerance {args.atol}")
+    # all concentrations in one process (pool), the structure and its symmetry are only set up once
+    concentrations = [str(conc) for conc in range(mixing_nums + 1)]
+    run_script(args.candidate_gen, ['--input', args.input, '--mode', args.mode_var, '--concentration', *concentrations, '--workers', args.workers, '--mixing_sites', *args.mixing, '--super_cell_long', *supercell.reshape(1,-1).tolist()[0], '--calc_path', f"{args.path}/tmp", '--tolerance', args.atol, '--symprec', args.symprec, *options])
 
 
 def determine_mixing_nums(str_path, mixing_sites, supercell, lim_bool):
@@ -144,6 +234,11 @@ def determine_mixing_nums(str_path, mixing_sites, supercell, lim_bool):
     return mix_num_sc
     
 
+def envelope_distances(max_distances):
+    # column wise largest cutoff of all rows, kept as the original strings
+    return [max([row[idx] for row in max_distances], key=float) for idx in range(len(max_distances[0]))]
+
+
 def read_in_max_distance(path):
     ret = []
     with open(path, 'r') as f:
@@ -1,12 +1,24 @@
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
 from pymatgen.core.structure import Structure
 
-from atat_lattice_file import configs_to_atat_str
-from config_generator import generate_base_lat_in, generate_candidate_configurations
+from atat_lattice_file import atat_template, write_config_store, write_configs
+from candidate_store import store_path
+from config_generator import generate_base_lat_in, generate_candidate_configurations, site_counts
+from correlation_engine import CorrelationEngine
+from sqs_search import AnnealingSearch, merge_chains
+from symmetry import count_configurations, count_unique_compositions, symmetry_permutations
+from tools import CORR_BLOCK_SIZE
+
+
+# rough memory of one entry (bytes object + set slot) of the set of visited permutations during the enumeration, plus one byte per site
+SEEN_ENTRY_BYTES = 100
+# bytes per cluster and candidate of a corrdump output line ('-0.12500\t')
+CORR_ENTRY_BYTES = 9
 
 
 
@@ -20,12 +32,15 @@ def main():
     parser.add_argument('-m', '--mode', dest='mode_var', default='unique',
                         help='The flag determining the mode in which the programm operates to generate the candidates. \
                             Options: unique - generate all symmetry unique structures using the bsym and pymatgen packages | default  \
+                                        native - same symmetry unique structures as unique, from a vectorized enumeration of canonical configurations \
+                                        random - draw --samples symmetry distinct structures at random, for supercells too large to enumerate \
                                         all - generate all structures using the bsym and pymatgen packages \
-                                        gensqs - using the gensqs tool from the ATAT program')
-    parser.add_argument('-c', '--concentration', dest='conc', type=float,
-                        help='The concentration (<1) or amount of mixing-2 atoms')
-    parser.add_argument('-mix', '--mixing_sites', dest='mixing', nargs=2, 
-                        help='Alloying Sites (first argument) and the replacement element')
+                                        gensqs - the --samples lowest error structures of a simulated annealing search in --chains parallel chains, for supercells too large to enumerate (binary mixing site, needs --max_distances or a clusters.out)')
+    parser.add_argument('-c', '--concentration', dest='conc', nargs='+',
+                        help='The concentration (<1) or amount of mixing-2 atoms. Several values generate all of them in one run. \
+                            With several replacement elements one comma separated value per replacement element, e.g. 0.25,0.125')
+    parser.add_argument('-mix', '--mixing_sites', dest='mixing', nargs='+', 
+                        help='Alloying Sites (first argument) and the replacement element(s)')
     parser.add_argument('-sc', '--super_cell', nargs=3, dest='sc_scaling', default=[1,1,1],
                         help='Scaling of the three cartesian basis vectors defaults to [1,1,1]')
     
@@ -42,7 +57,41 @@ def main():
     parser.add_argument('--super_cell_long', nargs=9, dest='sc_matrix', default=None,
                         help='Supercell matrix, defaults to None. If given takes precedent over -sc')
     parser.add_argument('--tolerance', dest='atol', type=float, default=1e-5,
-                        help='Tolerance when checking symmetry, Defaults to 1e-5')
+                        help='Tolerance of the coordinate mapping of bsym when the symmetry is detected on the supercell (--detect_symmetry), Defaults to 1e-5')
+    parser.add_argument('--symprec', dest='symprec', type=float, default=1e-2,
+                        help='Tolerance (in Angstrom) of the symmetry detection of --base_str, from which the symmetry of the supercell is built - Defaults to 1e-2')
+    parser.add_argument('--symmetry_cache', dest='symmetry_cache', default='symmetry_cache',
+                        help='Only with --detect_symmetry: directory (relative to --input) where the symmetry operations detected on the supercell are cached for all concentrations and later runs - Defaults to \'symmetry_cache\'')
+    parser.add_argument('--no_symmetry_cache', dest='cache_bool', action='store_false',
+                        help='Only with --detect_symmetry: always detect the symmetry operations of the supercell from scratch. The operations built from --base_str are never cached')
+    parser.add_argument('--detect_symmetry', dest='detect_bool', action='store_true',
+                        help='Detect the symmetry operations of the supercell with bsym (pymatgen) instead of building them from the symmetry of --base_str and the supercell matrix. Slow for large supercells')
+    parser.add_argument('--binary', dest='binary_bool', action='store_true',
+                        help='Write the candidates to the binary store \'\"candidate_file\".npz\' (shared coordinates, one bit per mixing site) instead of the text file')
+    parser.add_argument('--samples', dest='samples', type=int, default=1000,
+                        help='Number of symmetry distinct candidates per concentration in the random and gensqs modes - Defaults to 1000')
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='Seed of the random and gensqs modes, the same seed gives the same candidates - Defaults to None (not reproducible)')
+    parser.add_argument('-d', '--max_distances', nargs=5, dest='distances', default=None,
+                        help='gensqs: max distance in clusters, clusters.out is generated with corrdump -clus in --input. If not given, an existing clusters.out in --input is used')
+    parser.add_argument('--cluster_file', dest='clust_file', default='clusters.out',
+                        help='gensqs: File containing the clusters written by corrdump, relative to --input - Defaults to \'clusters.out\'')
+    parser.add_argument('--damping', dest='damping', type=float, default=2,
+                        help='gensqs: damping constant of the error that is minimized - Defaults to 2')
+    parser.add_argument('--chains', dest='chains', type=int, default=4,
+                        help='gensqs: number of independent annealing chains per concentration, run on --workers processes - Defaults to 4')
+    parser.add_argument('--steps', dest='steps', type=int, default=20000,
+                        help='gensqs: attempted swaps per chain - Defaults to 20000')
+    parser.add_argument('--temperature', dest='temperature', type=float, nargs=2, default=[5e-2, 1e-4],
+                        help='gensqs: temperature (in units of the error) at the first and the last step, geometric in between - Defaults to 5e-2 1e-4')
+    parser.add_argument('--verify_bsym', dest='verify_bool', action='store_true',
+                        help='Cross-check the configurations of the native mode with the unique mode (slow, for debugging)')
+    parser.add_argument('--dry_run', dest='dry_bool', action='store_true',
+                        help='Only count the candidates of every concentration (Burnside counting over the supercell symmetry) and print estimates of the file sizes, memory and time of the stages. Nothing is written')
+    parser.add_argument('--dry_run_rate', dest='dry_rate', type=float, default=1e6,
+                        help='Mixing sites per second corrdump evaluates per cluster, used for the time estimate of the dry run. Rough order of magnitude, calibrate with a small run - Defaults to 1e6')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of processes generating the concentrations, the ones with the most combinations are started first - Defaults to 1')
     
 
     global args
@@ -64,16 +113,32 @@ def main():
     supercell_structure = base_structure.make_supercell(supercell, in_place=False)
 
 
-    # determine the concentration
+    # determine the concentrations
     mixing_nums = np.sum([ (el.symbol == args.mixing[0]) for el in supercell_structure.species ])
 
-    if args.conc < 1:
-        num_sub = args.conc * mixing_nums
-        if round(num_sub % 1, 5) != 0:
-            raise ValueError("Concentration doesn't lead to integer number of mixing sites")
-        num_sub = int(num_sub)
-    else:
-        num_sub = int(args.conc)
+    num_subs = []
+    for composition in args.conc:
+        subs = []
+        for conc in [float(value) for value in composition.split(',')]:
+            if conc < 1:
+                num_sub = conc * mixing_nums
+                if round(num_sub % 1, 5) != 0:
+                    raise ValueError("Concentration doesn't lead to integer number of mixing sites")
+                num_sub = int(num_sub)
+            else:
+                num_sub = int(conc)
+            subs.append(num_sub)
+        # a number for a binary mixing site, a tuple with one number per replacement element otherwise
+        site_counts(subs, mixing_nums, args.mixing)
+        num_subs.append(subs[0] if len(subs) == 1 else tuple(subs))
+
+    # the operations of the supercell follow from the ones of the parent cell, only detected on the supercell on request.
+    # building them is cheap, so only the detected ones are cached
+    parent = None if args.detect_bool else (base_structure, supercell, args.symprec)
+    symmetry_cache = f"{args.input}/{args.symmetry_cache}" if args.cache_bool and parent is None else None
+    if args.dry_bool:
+        dry_run(supercell_structure, supercell, num_subs, args.mixing, args.mode_var, args.atol, symmetry_cache, args.dry_rate, args.samples, parent)
+        return
             
 
     # first write the lat.in in the input directory, if it doesn't already exist
@@ -83,32 +148,152 @@ def main():
             f.write( lat_in )
 
 
-    # set up the calculation directory
-    calc_dir = f'{args.calc_path}/sqs_{num_sub:0>{len(str(abs(mixing_nums)))}}'
-    set_up_calc_directory( f'{args.calc_path}/sqs_{num_sub:0>{len(str(abs(mixing_nums)))}}' )
+    jobs = {}
+    for num_sub in num_subs:
+        # set up the calculation directory
+        calc_dir = f'{args.calc_path}/sqs_{"_".join([f"{num:0>{len(str(abs(mixing_nums)))}}" for num in np.atleast_1d(num_sub).tolist()])}'
+        set_up_calc_directory( calc_dir )
 
+        output = f'{calc_dir}/{args.candidate_file}'
+        if args.binary_bool:
+            output = store_path(output)
+        jobs[num_sub] = output
 
-    # check the mode
     if args.mode_var == 'gensqs':
-        print('NOT IMPLEMENTED YET')
+        generate_gensqs(supercell_structure, supercell, jobs, args.mixing, symmetry_cache, parent)
+        return
+
+    if args.workers <= 1:
+        for num_sub, output in jobs.items():
+            num_configs = generate_concentration(supercell_structure, supercell, num_sub, mixing_nums, args.mixing, args.mode_var, args.atol, symmetry_cache, output, args.binary_bool, args.verify_bool, args.samples, args.seed, parent)
+            print(f"{num_configs} candidates written to {output}")
+        return
+
+    # the symmetry detection is done once here, the workers load it from the cache
+    if args.mode_var in ['unique', 'native', 'random'] and symmetry_cache is not None:
+        symmetry_permutations(supercell_structure, list(supercell_structure.indices_from_symbol(args.mixing[0])), args.atol, symmetry_cache)
+
+    # the largest concentrations (most combinations) first, so they don't hold up the end of the run
+    order = sorted(jobs, key=lambda num_sub: count_configurations(site_counts(num_sub, mixing_nums, args.mixing)), reverse=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {num_sub: pool.submit(generate_concentration, supercell_structure, supercell, num_sub, mixing_nums, args.mixing, args.mode_var, args.atol, symmetry_cache, jobs[num_sub], args.binary_bool, args.verify_bool, args.samples, args.seed, parent) for num_sub in order}
+        for num_sub in order:
+            print(f"{futures[num_sub].result()} candidates written to {jobs[num_sub]}")
+
+
+def generate_concentration(structure, supercell, num_sub, mixing_nums, mixing, mode, atol, symmetry_cache, output, binary=False, verify=False, samples=1000, seed=None, parent=None):
+    configs = generate_candidate_configurations(
+        mix_str     = structure, 
+        num_sub     = num_sub, 
+        mixing_nums = mixing_nums, 
+        mixing_sites= mixing, 
+        mode        = mode, 
+        atol        = atol,
+        symmetry_cache = symmetry_cache,
+        verify      = verify,
+        samples     = samples,
+        seed        = seed,
+        parent      = parent
+        )
+    # enumeration, rendering and writing are chained generators, only a block of candidates is in memory at a time
+    writer = write_config_store if binary else write_configs
+    return writer(
+        path        = output,
+        structure   = structure,
+        configs     = configs,
+        mixing_sites= mixing,
+        supercell   = supercell
+        )
+
+
+def generate_gensqs(structure, supercell, jobs, mixing, symmetry_cache, parent=None):
+    if len(mixing) != 2:
+        raise ValueError("The gensqs mode only supports binary mixing sites")
+
+    # clusters of the lat.in, the same for all concentrations
+    if args.distances:
+        src = os.getcwd()
+        os.chdir(args.input)
+        os.system(f'corrdump -noe -clus -l {args.lat_file} -2 {args.distances[0]} -3 {args.distances[1]} -4 {args.distances[2]} -5 {args.distances[3]} -6 {args.distances[4]}')
+        os.chdir(src)
+    if not os.path.exists(f"{args.input}/{args.clust_file}"):
+        raise ValueError(f"The gensqs mode needs --max_distances or the cluster file {args.input}/{args.clust_file}")
+
+    # the engine is set up with an arbitrary candidate of the supercell, the search only changes the species of its mixing sites
+    sqs = atat_template(structure, supercell).format(*[el.symbol for el in structure.species]).split("\n")
+    engine = CorrelationEngine(lattice_file = f"{args.input}/{args.lat_file}", 
+                               cluster_file = f"{args.input}/{args.clust_file}", 
+                               sqs          = sqs)
+    subset = list(structure.indices_from_symbol(mixing[0]))
+    if engine.mixing_atoms.tolist() != subset:
+        raise ValueError("The mixing sites of the lat.in and of the supercell don't match")
 
+    permutations = symmetry_permutations(structure, subset, args.atol, symmetry_cache, parent)
+    search = AnnealingSearch(engine, args.damping, permutations)
+
+    # every chain gets its own random stream, so the result doesn't depend on --workers
+    seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+    runs = [(num_sub, args.steps, args.temperature[0], args.temperature[1], args.samples, [seed, num_sub, chain]) for num_sub in jobs for chain in range(args.chains)]
+
+    if args.workers <= 1:
+        results = [search.run(*run) for run in runs]
     else:
-        configs = generate_candidate_configurations(
-            mix_str     = supercell_structure, 
-            num_sub     = num_sub, 
-            mixing_nums = mixing_nums, 
-            mixing_sites= args.mixing, 
-            mode        = args.mode_var, 
-            atol        = args.atol
-            )
-        candidates = configs_to_atat_str(
-            structure   = supercell_structure,
-            configs     = configs,
-            mixing_sites= args.mixing,
-            supercell   = supercell
-            )
-        with open(f'{calc_dir}/{args.candidate_file}', 'w') as f:
-            f.write(candidates)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(search.run, *run) for run in runs]
+            results = [future.result() for future in futures]
+
+    writer = write_config_store if args.binary_bool else write_configs
+    for num_sub, output in jobs.items():
+        best = merge_chains([result for run, result in zip(runs, results) if run[0] == num_sub], args.samples)
+        num_configs = writer(output, structure, (config for error, config in best), mixing, supercell)
+        print(f"{num_configs} candidates written to {output}, lowest error {best[0][0]:.5f}")
+
+
+def dry_run(structure, supercell, num_subs, mixing, mode, atol, symmetry_cache, rate, samples=1000, parent=None):
+    subset = list(structure.indices_from_symbol(mixing[0]))
+    num_sites = len(subset)
+
+    permutations = None
+    group_size = 1
+    if mode in ['unique', 'native', 'random', 'gensqs']:
+        permutations = symmetry_permutations(structure, subset, atol, symmetry_cache, parent)
+        group_size = len(np.unique(permutations, axis=0))
+
+    # the text of a candidate only differs in the species of the mixing sites
+    template = atat_template(structure, supercell)
+    fixed_size = len(template.replace('{}', '')) + sum([len(el.symbol) for idx, el in enumerate(structure.species) if idx not in subset])
+
+    print(f"{num_sites} mixing sites, {group_size} symmetry operations acting on them, mode {mode}\n")
+    print("conc\tcandidates\tall configurations\tsqs.out\t\tbinary store\tenumeration memory\ttcorr.out/cluster\terrors memory/cluster\tcorrdump time/cluster")
+    total = 0
+    for num_sub in num_subs:
+        counts = site_counts(num_sub, num_sites, mixing)
+        combinations = count_configurations(counts)
+        count = count_unique_compositions(permutations, counts) if permutations is not None else combinations
+        if mode in ['random', 'gensqs']:
+            count = min(count, samples)
+        total += count
+
+        text_size = count * (fixed_size + sum([num * len(species) for num, species in zip(counts, mixing)]))
+        # the binary store only exists for binary mixing sites
+        store_size = format_bytes(count * ((num_sites + 7)//8) + len(template)) if len(mixing) == 2 else '-'
+        # bsym visits every permutation, the set of visited equivalents holds at most the orbits of the candidates
+        seen_size = min(combinations, count * group_size) * (num_sites + SEEN_ENTRY_BYTES) if mode == 'unique' else 0
+        corr_size = count * CORR_ENTRY_BYTES
+        block_size = min(count, CORR_BLOCK_SIZE) * 8
+        seconds = count * num_sites / rate
+
+        conc = ",".join([str(num) for num in counts[1:]])
+        print(f"{conc}\t{count}\t\t{combinations}\t\t\t{format_bytes(text_size)}\t{store_size}\t{format_bytes(seen_size)}\t\t{format_bytes(corr_size)}\t\t{format_bytes(block_size)}\t\t\t{seconds:.3g} s")
+
+    print(f"\n{total} candidates in total")
+
+
+def format_bytes(size):
+    for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+        if size < 1000 or unit == 'TB':
+            return f"{size:.3g} {unit}"
+        size /= 1000
 
 
 def read_in_pmg(path):
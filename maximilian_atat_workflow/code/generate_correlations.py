@@ -1,8 +1,14 @@
 import os
 import shutil
 import argparse
+import itertools
 
-from tools import check_wdir
+import numpy as np
+
+from tools import check_wdir, get_coordinate_system, mirror_folders, read_lattice_mixing_species, read_out_cluster_file, CORR_BLOCK_SIZE
+from atat_lattice_file import iter_candidates, iter_lat_list
+from candidate_store import CandidateStore, store_path
+from correlation_engine import CorrelationEngine, format_correlations
 
 
 def main():
@@ -23,6 +29,22 @@ def main():
                         help='File to which the random correlations are written - Defaults to \'tcorr_rnd.out\'')
     parser.add_argument('--sqs_correlation_file', dest='scorr_file', default='tcorr.out',
                         help='File to which the correlations are written - Defaults to \'tcorr.out\'')
+    parser.add_argument('--cluster_file', dest='clust_file', default='clusters.out',
+                        help='File containing the clusters written by corrdump - Defaults to \'clusters.out\'')
+    parser.add_argument('--analytic_random', dest='analytic_bool', action='store_true',
+                        help='Compute the random correlations of a binary mixing site from the concentration and clusters.out instead of a second corrdump run. \
+                            The random correlation file then only contains a single row, which holds for all candidates of the concentration')
+    parser.add_argument('--engine', dest='engine', default='corrdump', choices=['corrdump', 'native'],
+                        help='corrdump - correlations of all candidates by corrdump | default \
+                              native - corrdump only generates clusters.out, the correlations are computed in python (binary mixing sites only)')
+    parser.add_argument('--reuse_envelope', dest='reuse_bool', action='store_true',
+                        help='The folders already contain clusters.out and the correlation files for larger cutoffs (e.g. the envelope of all rows of distance.dat). \
+                            Only the clusters within --max_distances and their correlation columns are kept, no correlations are computed')
+    parser.add_argument('--symprec', dest='symprec', type=float, default=1e-3,
+                        help='Tolerance of the symmetry detection of the native engine - Defaults to 1e-3')
+    parser.add_argument('--mirror', dest='mirror_bool', action='store_true',
+                        help='Only compute the correlations for x <= 0.5 (binary mixing site only). The folders of x > 0.5 are written from them by exchanging the two species, \
+                            which flips the sign of the correlations of clusters with an odd number of nodes')
     
     global args
     args = parser.parse_args()
@@ -31,24 +53,75 @@ def main():
         f.write(f"{args.calc_path}: Distance Parameters are: {" ".join(args.distances)}")
         f.close()
 
+    folders = sorted(os.listdir(args.calc_path))
+    mirrors = {}
+    if args.mirror_bool:
+        mirrors = mirror_folders(args.calc_path, f"{args.input}/{args.lat_file}", args.candidate_file)
+        folders = [folder for folder in folders if folder not in mirrors.values()]
+
     # set up working directory
-    for folder in sorted(os.listdir(args.calc_path)):
+    for folder in folders:
         if not os.path.exists(f"{args.calc_path}/{folder}/{args.lat_file}"):
             shutil.copyfile(f"{args.input}/{args.lat_file}", f"{args.calc_path}/{folder}/{args.lat_file}")
 
-        check_wdir(f"{args.calc_path}/{folder}", [args.lat_file, args.candidate_file])
+        # the candidates are either a text file or a binary store (generate_candidates --binary)
+        binary_bool = not os.path.exists(f"{args.calc_path}/{folder}/{args.candidate_file}")
+        check_wdir(f"{args.calc_path}/{folder}", [args.lat_file, store_path(args.candidate_file) if binary_bool else args.candidate_file])
         
+        if args.reuse_bool:
+            print(f"Selecting the correlations of {args.calc_path}/{folder} from the envelope cutoffs")
+            select_cutoff_subset(wdir           = f"{args.calc_path}/{folder}", 
+                                 max_distances  = args.distances, 
+                                 cluster_file   = args.clust_file, 
+                                 corr_files     = [args.scorr_file, args.rcorr_file])
+            continue
+
         print(f"Generating correlations for {args.calc_path}/{folder}")
-        generate_correlations(wdir          = f"{args.calc_path}/{folder}", 
-                              max_distances = args.distances, 
-                              candidates    = args.candidate_file, 
-                              output        = args.rcorr_file, 
-                              random_bool   = True)
+        if args.engine == 'native':
+            num_sqs = generate_native_correlations(wdir          = f"{args.calc_path}/{folder}", 
+                                                   max_distances = args.distances, 
+                                                   candidates    = args.candidate_file, 
+                                                   cluster_file  = args.clust_file, 
+                                                   output        = args.scorr_file)
+            # without --analytic_random one row per candidate, like corrdump -rnd
+            generate_random_correlations(wdir           = f"{args.calc_path}/{folder}", 
+                                         candidates     = args.candidate_file, 
+                                         cluster_file   = args.clust_file, 
+                                         output         = args.rcorr_file,
+                                         num_rows       = 1 if args.analytic_bool else num_sqs)
+            continue
+
+        # corrdump needs the text of all candidates, it only exists while corrdump runs
+        if binary_bool:
+            CandidateStore(f"{args.calc_path}/{folder}/{store_path(args.candidate_file)}").write_text(f"{args.calc_path}/{folder}/{args.candidate_file}")
+
+        if not args.analytic_bool:
+            generate_correlations(wdir          = f"{args.calc_path}/{folder}", 
+                                  max_distances = args.distances, 
+                                  candidates    = args.candidate_file, 
+                                  output        = args.rcorr_file, 
+                                  random_bool   = True)
         generate_correlations(wdir          = f"{args.calc_path}/{folder}", 
                               max_distances = args.distances, 
                               candidates    = args.candidate_file, 
                               output        = args.scorr_file, 
                               random_bool   = False)
+        if args.analytic_bool:
+            # clusters.out is written by the corrdump run above
+            generate_random_correlations(wdir           = f"{args.calc_path}/{folder}", 
+                                         candidates     = args.candidate_file, 
+                                         cluster_file   = args.clust_file, 
+                                         output         = args.rcorr_file)
+        if binary_bool:
+            os.remove(f"{args.calc_path}/{folder}/{args.candidate_file}")
+
+    for src, dst in mirrors.items():
+        print(f"Mirroring the correlations of {args.calc_path}/{src} to {args.calc_path}/{dst}")
+        mirror_correlations(src_dir     = f"{args.calc_path}/{src}", 
+                            dst_dir     = f"{args.calc_path}/{dst}", 
+                            candidates  = args.candidate_file, 
+                            cluster_file= args.clust_file, 
+                            corr_files  = [args.scorr_file, args.rcorr_file])
         
 
 def generate_correlations(wdir, max_distances, candidates, output, random_bool = True):
@@ -62,6 +135,128 @@ def generate_correlations(wdir, max_distances, candidates, output, random_bool =
     os.system(f'corrdump -noe -l {args.lat_file} -2 {max_distances[0]} -3 {max_distances[1]} -4 {max_distances[2]} -5 {max_distances[3]} -6 {max_distances[4]} -s {candidates} {rand_flag} > {output}')
     os.chdir(src)
 
+
+def generate_native_correlations(wdir, max_distances, candidates, cluster_file, output):
+    # corrdump only writes the clusters, the candidates are never handed to an external process
+    src = os.getcwd()
+    os.chdir(wdir)
+    os.system(f'corrdump -noe -clus -l {args.lat_file} -2 {max_distances[0]} -3 {max_distances[1]} -4 {max_distances[2]} -5 {max_distances[3]} -6 {max_distances[4]}')
+    os.chdir(src)
+
+    if not os.path.exists(f"{wdir}/{candidates}"):
+        return generate_store_correlations(wdir, candidates, cluster_file, output)
+
+    sqs_list = (sqs for sqs in iter_lat_list(f"{wdir}/{candidates}") if sqs != [])
+    first = next(sqs_list)
+    engine = CorrelationEngine(lattice_file  = f"{wdir}/{args.lat_file}", 
+                               cluster_file  = f"{wdir}/{cluster_file}", 
+                               sqs           = first, 
+                               symprec       = args.symprec)
+
+    num_sqs = 0
+    with open(f"{wdir}/{output}", 'w') as f:
+        for block in itertools.batched(itertools.chain([first], sqs_list), CORR_BLOCK_SIZE):
+            f.write(format_correlations(engine.correlations(engine.occupations(block))))
+            num_sqs += len(block)
+
+    return num_sqs
+
+
+def generate_store_correlations(wdir, candidates, cluster_file, output):
+    # the occupations are unpacked straight from the binary store, only the first candidate is rendered
+    store = CandidateStore(f"{wdir}/{store_path(candidates)}")
+    engine = CorrelationEngine(lattice_file  = f"{wdir}/{args.lat_file}", 
+                               cluster_file  = f"{wdir}/{cluster_file}", 
+                               sqs           = store.lines(0), 
+                               symprec       = args.symprec)
+
+    with open(f"{wdir}/{output}", 'w') as f:
+        for start in range(0, len(store), CORR_BLOCK_SIZE):
+            f.write(format_correlations(engine.correlations(engine.store_occupations(store, start, start + CORR_BLOCK_SIZE))))
+
+    return len(store)
+
+
+def select_cutoff_subset(wdir, max_distances, cluster_file, corr_files):
+    # the clusters of smaller cutoffs are a subset of the envelope clusters, so their correlations are just a selection of columns
+    clusters = read_out_cluster_file(f"{wdir}/{cluster_file}", get_coordinate_system(f"{wdir}/{args.lat_file}"))
+    mask = clusters.cutoff_mask(max_distances)
+
+    with open(f"{wdir}/{cluster_file}", 'w') as f:
+        f.write("".join(["".join(cluster.data) + "\n" for cluster, keep in zip(clusters, mask) if keep]))
+
+    # the columns are copied as text, so the values stay exactly the ones corrdump (or the native engine) wrote
+    columns = np.flatnonzero(mask)
+    for corr_file in corr_files:
+        with open(f"{wdir}/{corr_file}", 'r') as src, open(f"{wdir}/{corr_file}.tmp", 'w') as dst:
+            for line in src:
+                values = line.split()
+                dst.write("".join([f"{values[col]}\t" for col in columns]) + "\n")
+        os.replace(f"{wdir}/{corr_file}.tmp", f"{wdir}/{corr_file}")
+
+
+def mirror_correlations(src_dir, dst_dir, candidates, cluster_file, corr_files):
+    # exchanging the species of the binary mixing site turns the occupation variables into their negatives,
+    # the correlations of clusters with an odd number of nodes change sign, the others stay the same
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    for file in [args.lat_file, cluster_file]:
+        shutil.copyfile(f"{src_dir}/{file}", f"{dst_dir}/{file}")
+
+    if os.path.exists(f"{src_dir}/{candidates}"):
+        mirror_candidates(f"{src_dir}/{candidates}", f"{dst_dir}/{candidates}", read_lattice_mixing_species(f"{src_dir}/{args.lat_file}")[0])
+    else:
+        CandidateStore(f"{src_dir}/{store_path(candidates)}").mirrored(f"{dst_dir}/{store_path(candidates)}")
+
+    # the values are flipped as text, so they stay exactly the ones written for the source folder
+    clusters = read_out_cluster_file(f"{src_dir}/{cluster_file}", get_coordinate_system(f"{src_dir}/{args.lat_file}"))
+    odd = clusters.num_nodes % 2 == 1
+    for corr_file in corr_files:
+        with open(f"{src_dir}/{corr_file}", 'r') as src, open(f"{dst_dir}/{corr_file}", 'w') as dst:
+            for line in src:
+                dst.write("".join([f"{flip_sign(value) if flip else value}\t" for value, flip in zip(line.split(), odd)]) + "\n")
+
+
+def mirror_candidates(src_path, dst_path, mixing_species):
+    exchange = {mixing_species[0]: mixing_species[1], mixing_species[1]: mixing_species[0]}
+
+    with open(src_path, 'r') as src, open(dst_path, 'w') as dst:
+        for line in src:
+            species = line.rstrip().rsplit(maxsplit=1)[-1] if line.strip() != '' else ''
+            if species in exchange:
+                end = len(line.rstrip())
+                line = line[:end - len(species)] + exchange[species] + line[end:]
+            dst.write(line)
+
+
+def flip_sign(value):
+    if value.startswith('-'):
+        return value[1:]
+    if float(value) == 0:
+        return value
+    return f"-{value}"
+
+
+def generate_random_correlations(wdir, candidates, cluster_file, output, num_rows=1):
+    mixing_species = read_lattice_mixing_species(f"{wdir}/{args.lat_file}")
+    if len(mixing_species) != 1 or len(mixing_species[0]) != 2:
+        raise ValueError(f"Analytic random correlations need exactly one binary mixing site, found {mixing_species} in {wdir}/{args.lat_file}")
+
+    # all candidates of a folder share the concentration, so the first one determines it
+    sqs = next(iter_candidates(f"{wdir}/{candidates}"))
+    species = [line.split()[3] for line in sqs[6:]]
+    num_1 = species.count(mixing_species[0][0])
+    num_2 = species.count(mixing_species[0][1])
+
+    clusters = read_out_cluster_file(f"{wdir}/{cluster_file}", get_coordinate_system(f"{wdir}/{args.lat_file}"))
+    rcorr = clusters.random_correlations((num_2 - num_1)/(num_1 + num_2))
+
+    # same layout as the corrdump output
+    row = "".join([f"{corr:.5f}\t" for corr in rcorr]) + "\n"
+    with open(f"{wdir}/{output}", 'w') as f:
+        for start in range(0, num_rows, CORR_BLOCK_SIZE):
+            f.write(row * min(CORR_BLOCK_SIZE, num_rows - start))
+
     
 
         
@@ -0,0 +1,233 @@
+import os
+import itertools
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import spglib
+
+from pymatgen.core.structure import Structure
+
+from atat_lattice_file import atat_template
+from compare_correlations import cluster_weights
+from config_generator import generate_base_lat_in, generate_candidate_configurations
+from correlation_engine import CorrelationEngine
+from sqs_search import AnnealingSearch, merge_chains
+from symmetry import symmetry_permutations
+from tools import CORR_BLOCK_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser("SQS-Supercell Search")
+
+    parser.add_argument('-i', '--input', dest='input', default='input',
+                        help='The path where the input files are stored/generated - Defaults to \'input\' ')
+    parser.add_argument('--base_str', dest='base_path', default='base.vasp',
+                        help='The path of the input structure, relative to --input - Defaults to \'base.vasp\'')
+    parser.add_argument('--lattice_file', dest='lat_file', default='lat.in',
+                        help='Name of the lattice file - Defaults to \'lat.in\'')
+    parser.add_argument('--cluster_file', dest='clust_file', default='clusters.out',
+                        help='File containing the clusters written by corrdump, relative to --input - Defaults to \'clusters.out\'')
+    parser.add_argument('-mix', '--mixing_sites', dest='mixing', nargs=2,
+                        help='Alloying Sites (first argument) and the replacement element')
+    parser.add_argument('-s', '--size', dest='sizes', type=int, nargs='+',
+                        help='Number of unit cells of --base_str in the supercells, all Hermite normal form supercells of every size are searched')
+    parser.add_argument('-c', '--concentration', dest='conc', type=float, nargs='+',
+                        help='Target concentration(s) of the replacement element (<1), sizes that give no integer number of sites are skipped')
+    parser.add_argument('-d', '--max_distances', nargs=5, dest='distances', default=None,
+                        help='max distance in clusters, clusters.out is generated with corrdump -clus in --input. If not given, an existing clusters.out in --input is used')
+    parser.add_argument('--damping', dest='damping', type=float, default=2,
+                        help='The value of the damping constant - Defaults to 2')
+    parser.add_argument('-m', '--mode', dest='mode_var', default='native', choices=['native', 'random', 'gensqs'],
+                        help='Candidates of every supercell: native - all symmetry unique ones | default \
+                                                             random - --samples random symmetry distinct ones \
+                                                             gensqs - --samples best ones of --chains annealing chains of --steps swaps')
+    parser.add_argument('--samples', dest='samples', type=int, default=1000,
+                        help='Number of candidates per supercell in the random and gensqs modes - Defaults to 1000')
+    parser.add_argument('--chains', dest='chains', type=int, default=4,
+                        help='gensqs: number of annealing chains per supercell - Defaults to 4')
+    parser.add_argument('--steps', dest='steps', type=int, default=20000,
+                        help='gensqs: attempted swaps per chain - Defaults to 20000')
+    parser.add_argument('--temperature', dest='temperature', type=float, nargs=2, default=[5e-2, 1e-4],
+                        help='gensqs: temperature (in units of the error) at the first and the last step - Defaults to 5e-2 1e-4')
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='Seed of the random and gensqs modes - Defaults to None (not reproducible)')
+    parser.add_argument('--tolerance', dest='atol', type=float, default=1e-5,
+                        help='Tolerance of the coordinate mapping of bsym, only used if the symmetry is detected on the supercell (it is built from the parent cell here), Defaults to 1e-5')
+    parser.add_argument('--symprec', dest='symprec', type=float, default=1e-3,
+                        help='Tolerance (in Angstrom) of the symmetry detection of the parent lattice, used for the lattice rotations, the correlations and the symmetry of the supercells - Defaults to 1e-3')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of processes, every process scores one supercell at a time - Defaults to 1')
+    parser.add_argument('-o', '--output', dest='output', default='supercells.out',
+                        help='File the scores are written to, one line per supercell and concentration, lowest error first. \
+                            The first nine numbers of a line can be passed to --super_cell_long - Defaults to \'supercells.out\'')
+
+    global args
+    args = parser.parse_args()
+
+    base_structure = Structure.from_file(f"{args.input}/{args.base_path}")
+
+    # lat.in and clusters.out of the parent lattice are shared by all supercells
+    lat_in = generate_base_lat_in(args.input, base_structure, args.mixing)
+    if lat_in:
+        with open(f'{args.input}/{args.lat_file}', 'w') as f:
+            f.write(lat_in)
+    if args.distances:
+        src = os.getcwd()
+        os.chdir(args.input)
+        os.system(f'corrdump -noe -clus -l {args.lat_file} -2 {args.distances[0]} -3 {args.distances[1]} -4 {args.distances[2]} -5 {args.distances[3]} -6 {args.distances[4]}')
+        os.chdir(src)
+    if not os.path.exists(f"{args.input}/{args.clust_file}"):
+        raise ValueError(f"The supercell search needs --max_distances or the cluster file {args.input}/{args.clust_file}")
+
+    rotations = lattice_rotations(base_structure, args.symprec)
+    mixing_per_cell = sum([el.symbol == args.mixing[0] for el in base_structure.species])
+
+    jobs = []
+    for size in args.sizes:
+        num_subs = {conc: conc * size * mixing_per_cell for conc in args.conc}
+        num_subs = {conc: int(round(num_sub)) for conc, num_sub in num_subs.items() if round(num_sub % 1, 5) in [0, 1]}
+        if num_subs == {}:
+            print(f"Size {size}: no integer number of sites for the concentrations {args.conc}, skipped")
+            continue
+
+        matrices = hermite_normal_forms(size)
+        supercells = unique_supercells(matrices, rotations)
+        print(f"Size {size}: {len(supercells)} symmetry distinct of {len(matrices)} supercells")
+        jobs += [(supercell, num_subs) for supercell in supercells]
+
+    # the largest supercells first, so they don't hold up the end of the run
+    jobs.sort(key=lambda job: supercell_size(job[0]), reverse=True)
+    settings = {key: getattr(args, key) for key in ['input', 'lat_file', 'clust_file', 'mixing', 'damping', 'mode_var', 'samples', 'chains', 'steps', 'temperature', 'seed', 'atol', 'symprec']}
+
+    if args.workers <= 1:
+        results = [score_supercell(base_structure, supercell, num_subs, settings) for supercell, num_subs in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(score_supercell, base_structure, supercell, num_subs, settings) for supercell, num_subs in jobs]
+            results = [future.result() for future in futures]
+
+    # per concentration the lowest error first, ties go to the smaller supercell
+    rows = sorted([row for result in results for row in result], key=lambda row: (row[1], row[4], supercell_size(row[0])))
+    with open(args.output, 'w') as f:
+        for supercell, conc, num_sub, num_candidates, error in rows:
+            f.write(f"{" ".join([str(comp) for comp in supercell.reshape(-1).tolist()])}\t{supercell_size(supercell)}\t{conc}\t{num_sub}\t{num_candidates}\t{error}\n")
+
+    print("\nsupercell\t\t\tsize\tconc\tsubstituted\tcandidates\tlowest error")
+    for supercell, conc, num_sub, num_candidates, error in rows:
+        print(f"{" ".join([str(comp) for comp in supercell.reshape(-1).tolist()])}\t{supercell_size(supercell)}\t{conc}\t{num_sub}\t\t{num_candidates}\t\t{error:.6f}")
+
+
+def score_supercell(base_structure, supercell, num_subs, settings):
+    """
+    Input:
+    * base_structure - pymatgen structure of the parent cell
+    * supercell - integer supercell matrix (rows in units of the parent cell vectors)
+    * num_subs - number of substituted mixing sites per target concentration
+    * settings - dictionary of the command line settings (the workers don't share the global args)
+
+    Use --> candidate, correlation and error stage of the workflow for one supercell, with the native correlation
+            engine and the damped error of compare_correlations, keeping only the lowest error per concentration
+
+    Returns => list of (supercell, concentration, number of substituted sites, number of candidates, lowest error)
+    """
+    structure = base_structure.make_supercell(supercell, in_place=False)
+    mixing = settings['mixing']
+    subset = list(structure.indices_from_symbol(mixing[0]))
+
+    sqs = atat_template(structure, supercell).format(*[el.symbol for el in structure.species]).split("\n")
+    engine = CorrelationEngine(lattice_file = f"{settings['input']}/{settings['lat_file']}",
+                               cluster_file = f"{settings['input']}/{settings['clust_file']}",
+                               sqs          = sqs,
+                               symprec      = settings['symprec'])
+    if engine.mixing_atoms.tolist() != subset:
+        raise ValueError("The mixing sites of the lat.in and of the supercell don't match")
+    weights = cluster_weights(engine.clusters, settings['damping'])
+
+    if settings['mode_var'] == 'gensqs':
+        search = AnnealingSearch(engine, settings['damping'], symmetry_permutations(structure, subset, parent=(base_structure, supercell, settings['symprec'])))
+        seed = settings['seed'] if settings['seed'] is not None else np.random.SeedSequence().entropy
+
+    rows = []
+    for conc, num_sub in num_subs.items():
+        rcorr = engine.clusters.random_correlations(2*num_sub/len(subset) - 1)
+
+        if settings['mode_var'] == 'gensqs':
+            chains = [search.run(num_sub, settings['steps'], *settings['temperature'], settings['samples'], [seed, num_sub, chain] + supercell.reshape(-1).tolist()) for chain in range(settings['chains'])]
+            best = merge_chains(chains, settings['samples'])
+            rows.append((supercell, conc, num_sub, len(best), best[0][0]))
+            continue
+
+        configs = generate_candidate_configurations(structure, num_sub, len(subset), mixing, settings['mode_var'], atol=settings['atol'], samples=settings['samples'], seed=settings['seed'], parent=(base_structure, supercell, settings['symprec']))
+        num_candidates = 0
+        lowest = np.inf
+        for block in itertools.batched(configs, CORR_BLOCK_SIZE):
+            sigma = np.where(np.array(block, dtype='uint8') == 1, 1, -1).astype('int8')
+            corr = engine.correlations(sigma)
+            lowest = min(lowest, float((np.abs(corr[:, 1:] - rcorr[1:]) @ weights).min()))
+            num_candidates += len(block)
+        rows.append((supercell, conc, num_sub, num_candidates, lowest))
+
+    return rows
+
+
+def supercell_size(supercell):
+    return int(round(abs(np.linalg.det(supercell))))
+
+
+def hermite_normal_forms(size):
+    # all supercells of size parent cells, as upper triangular Hermite normal forms (rows: supercell vectors in units of the
+    # parent vectors): every superlattice has exactly one of them
+    matrices = []
+    for a in range(1, size + 1):
+        for c in range(1, size//a + 1):
+            if size % (a*c) != 0:
+                continue
+            f = size//(a*c)
+            for b, d, e in itertools.product(range(c), range(f), range(f)):
+                matrices.append(np.array([[a, b, d], [0, c, e], [0, 0, f]], dtype='int64'))
+    return matrices
+
+
+def hermite_normal_form(matrix):
+    # upper triangular form of the rows of an integer matrix under unimodular row operations (same superlattice)
+    h = np.array(matrix, dtype='int64')
+    for col in range(3):
+        # euclid on the rows col ... 2 until only one of them has a non zero entry in this column
+        while np.count_nonzero(h[col:, col]) > 1:
+            rows = [row for row in range(col, 3) if h[row, col] != 0]
+            pivot = min(rows, key=lambda row: abs(h[row, col]))
+            for row in rows:
+                if row != pivot:
+                    h[row] -= (h[row, col]//h[pivot, col]) * h[pivot]
+        pivot = col + int(np.flatnonzero(h[col:, col])[0])
+        h[[col, pivot]] = h[[pivot, col]]
+        if h[col, col] < 0:
+            h[col] *= -1
+        for row in range(col):
+            h[row] -= (h[row, col]//h[col, col]) * h[col]
+    return h
+
+
+def lattice_rotations(structure, symprec=1e-3):
+    # rotations of the parent crystal acting on lattice vectors from the right (rows of the lattice matrix): a supercell
+    # matrix H and H @ rotation describe symmetry equivalent supercells
+    symmetry = spglib.get_symmetry((structure.lattice.matrix, structure.frac_coords, [el.Z for el in structure.species]), symprec=symprec)
+    return np.unique(np.transpose(symmetry['rotations'], (0, 2, 1)), axis=0)
+
+
+def unique_supercells(matrices, rotations):
+    # one supercell (the first one in the list) per class of symmetry equivalent supercells
+    seen = set()
+    unique = []
+    for matrix in matrices:
+        key = min([tuple(hermite_normal_form(matrix @ rotation).reshape(-1).tolist()) for rotation in rotations])
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(matrix)
+    return unique
+
+
+if __name__ == '__main__':
+    main()
@@ -4,14 +4,29 @@ import sys
 import time
 
 import argparse
+import bisect
 import random
-import pandas as pd
 import numpy as np
 
 from pymatgen.analysis.structure_matcher import StructureMatcher
+from pymatgen.core import Lattice, Structure
 from pymatgen.io.atat import Mcsqs
 
-from atat_lattice_file import read_in_lat_list, write_lat_list
+from atat_lattice_file import select_candidates, write_lat_list
+from compare_correlations import cluster_weights, corr_block_pairs, weighted_errors
+from config_generator import canonical_keys, canonical_weights
+from symmetry import parent_permutations, parent_sites
+import tools
+
+
+# number of clusters added to the partial sums between two pruning steps
+PRUNE_STEP = 4
+
+# number of sqs scored between two updates of the pruning threshold
+PRUNE_ROWS = 64
+
+# number of candidates whose canonical keys are computed in one batch
+KEY_BLOCK_SIZE = 1000
 
 
 def main():
@@ -34,10 +49,34 @@ def main():
                         help='File to which the sqs candidates are written - Defaults to \'sqs.out\'')
     parser.add_argument('--error_file', dest='error_file', default='errors.out',
                         help='File to which the errors are written - Defaults to \'errors.out\'')
+    parser.add_argument('--error_column', dest='error_column', type=int, nargs='+', default=[0],
+                        help='Column of the error file the sqs are ranked by, e.g. one damping constant of a damping sweep or one scorer of compare_correlations. \
+                            With several columns the sqs are ranked lexicographically, ties of the first column are decided by the second and so on - Defaults to 0')
+    parser.add_argument('--from_correlations', dest='stream_bool', action='store_true',
+                        help='Find the lowest error sqs directly from the correlation files with a pruned partial sum instead of reading the error file \
+                            (single damping constant, --num_errors >= 1)')
+    parser.add_argument('--block_size', dest='block_size', type=int, default=tools.CORR_BLOCK_SIZE,
+                        help=f'Number of sqs whose correlations are held in memory at once with --from_correlations - Defaults to {tools.CORR_BLOCK_SIZE}')
+    parser.add_argument('--cache', dest='cache', action='store_true',
+                        help='Read and write binary \'.npy\' caches next to the correlation files with --from_correlations, so later selections don\'t parse them again')
+    parser.add_argument('--damping', dest='damping', type=float, default=2,
+                        help='The value of the damping constant used with --from_correlations - Defaults to 2')
+    parser.add_argument('--lattice_file', dest='lat_file', default='lat.in',
+                        help='Name of the lattice file - Defaults to \'lat.in\'')
+    parser.add_argument('--cluster_files', dest='clust_file', default='clusters.out',
+                        help='File containing the clusters - Defaults to \'clusters.out\'')
+    parser.add_argument('--random_correlation_file', dest='rcorr_file', default='tcorr_rnd.out',
+                        help='File containing the random correlations - Defaults to \'tcorr_rnd.out\'')
+    parser.add_argument('--sqs_correlation_file', dest='scorr_file', default='tcorr.out',
+                        help='File containing the correlations - Defaults to \'tcorr.out\'')
     parser.add_argument('--precision', dest='prec', type=int, default=7,
                         help='Precision for float comparison - Defaults to 7')
     parser.add_argument('--supercell', dest='sc', nargs=9, default=[1, 0, 0, 0, 1, 0, 0, 0, 1],
                         help='Supercell array to be used as the unit cell in the lat.in representation (defaults to unit matrix)')
+    parser.add_argument('--symprec', dest='symprec', type=float, default=1e-2,
+                        help='Tolerance (in Angstrom) of the symmetry detection of the lat.in for the canonical occupation keys, use the value of the candidate generation - Defaults to 1e-2')
+    parser.add_argument('--verify_matcher', dest='verify_bool', action='store_true',
+                        help='Cross-check the symmetry unique sqs (canonical occupation keys) with pymatgen\'s StructureMatcher (slow, for debugging)')
     parser.add_argument('--seed', dest='seed', default=None,
                         help='randomness seed. default taken from sys parameters')
     parser.add_argument('--verbose', dest='verbose', type=int, default=0,
@@ -62,13 +101,30 @@ def main():
         path = f"{args.calc_path}/{folder}"
         os.system(f'echo {seed} > {path}/seed.dat')
 
-        sqs_dict = get_lowest_error_sqs(path=path, 
-                                        sqs_file=args.candidate_file, 
-                                        error_file=args.error_file, 
-                                        precision=args.prec, 
-                                        num_errors=args.num_err)
+        if args.stream_bool and args.num_err >= 1:
+            sqs_dict = stream_lowest_error_sqs(path=path, 
+                                               sqs_file=args.candidate_file, 
+                                               scorr_file=args.scorr_file, 
+                                               rcorr_file=args.rcorr_file, 
+                                               cluster_file=args.clust_file, 
+                                               lattice_file=args.lat_file, 
+                                               damping=args.damping, 
+                                               precision=args.prec, 
+                                               num_errors=args.num_err,
+                                               block_size=args.block_size,
+                                               cache=args.cache,
+                                               verbose=args.verbose)
+        else:
+            sqs_dict = get_lowest_error_sqs(path=path, 
+                                            sqs_file=args.candidate_file, 
+                                            error_file=args.error_file, 
+                                            precision=args.prec, 
+                                            num_errors=args.num_err,
+                                            columns=args.error_column)
         
-        unique_sqs_dict = determine_sym_unique(sqs_dict=sqs_dict)
+        # without a lat.in the candidates can't be mapped onto the parent lattice, so the StructureMatcher decides
+        lattice_file = f"{path}/{args.lat_file}" if os.path.exists(f"{path}/{args.lat_file}") else None
+        unique_sqs_dict = determine_sym_unique(sqs_dict=sqs_dict, lattice_file=lattice_file, verify=args.verify_bool, symprec=args.symprec)
         
         if args.write_unique:
             unique_sqs_list = []
@@ -94,35 +150,158 @@ def main():
                            )
 
 
-def get_lowest_error_sqs(path, sqs_file, error_file, precision, num_errors):
-    sqs_list = read_in_lat_list(f"{path}/{sqs_file}")
-
-    errors = [round(float(value.strip()), int(precision)) for value in open(f"{path}/{error_file}", 'r').readlines()]
-    unique_errors = pd.Series(sorted(pd.Series(errors).unique()))
-    
-    if num_errors > unique_errors.size:
-        num_errors = int(unique_errors.size + 1)
-    elif num_errors < 1:
-        num_errors = int(unique_errors.size * num_errors)
-    else:
-        num_errors = int(num_errors)
-    
-    important_errors = unique_errors.iloc[0: num_errors].to_list()
+def get_lowest_error_sqs(path, sqs_file, error_file, precision, num_errors, columns=(0,)):
+    # errors and candidates are streamed, only the sqs within the lowest errors are kept in memory (and rendered, for a binary store)
+    important_errors = get_lowest_errors(f"{path}/{error_file}", precision, num_errors, columns)
     
     important_sqs = {error:[] for error in important_errors}
+    kept = {}
     
-    for sqs, error in zip(sqs_list, errors):
-        if round(float(error),int(precision)) in important_errors:
-                important_sqs[error].append(sqs)
+    with open(f"{path}/{error_file}", 'r') as errors:
+        for idx, value in enumerate(errors):
+            error = error_key(value, columns, precision)
+            if error in important_sqs:
+                kept[idx] = error
+
+    for idx, sqs in select_candidates(f"{path}/{sqs_file}", kept).items():
+        important_sqs[kept[idx]].append(sqs)
+
+    return important_sqs
+
+
+def get_lowest_errors(path, precision, num_errors, columns=(0,)):
+    # the num_errors lowest unique errors (or the fraction num_errors < 1 of all unique errors) in one pass over the error file
+    with open(path, 'r') as errors:
+        values = (error_key(value, columns, precision) for value in errors)
+
+        if num_errors < 1:
+            unique_errors = sorted(set(values))
+            return unique_errors[0: int(len(unique_errors) * num_errors)]
+
+        num_errors = int(num_errors)
+        lowest_errors = []
+        for error in values:
+            if len(lowest_errors) == num_errors and error >= lowest_errors[-1]:
+                continue
+
+            idx = bisect.bisect_left(lowest_errors, error)
+            if idx == len(lowest_errors) or lowest_errors[idx] != error:
+                lowest_errors.insert(idx, error)
+                if len(lowest_errors) > num_errors:
+                    lowest_errors.pop()
+
+    return lowest_errors
+
+
+def error_key(line, columns, precision):
+    # rounded error of a line of the error file, a tuple (compared lexicographically) if several columns rank the sqs
+    values = line.split()
+    if len(columns) == 1:
+        return round(float(values[columns[0]]), int(precision))
+    return tuple([round(float(values[col]), int(precision)) for col in columns])
+
+
+def stream_lowest_error_sqs(path, sqs_file, scorr_file, rcorr_file, cluster_file, lattice_file, damping, precision, num_errors, block_size=tools.CORR_BLOCK_SIZE, cache=False, verbose=0):
+    """
+    Same result as get_lowest_error_sqs, but computed from the correlations without materializing all errors:
+    the error is a sum of non-negative cluster terms, so a sqs whose partial sum (largest weights first)
+    already exceeds the current num_errors-th lowest error can't end up in one of the lowest errors
+    """
+    clusters = tools.read_out_cluster_file(f"{path}/{cluster_file}", tools.get_coordinate_system(f"{path}/{lattice_file}"))
+    weights = cluster_weights(clusters, damping)
+    order = np.argsort(-weights, kind='stable')
+
+    # errors that round to a kept error may exceed it by half a digit, the margin also covers the different summation order
+    margin = 10.0**(-int(precision))
+    num_errors = int(num_errors)
+    lowest_errors = []
+    kept = {}
+    scored = 0
+
+    offset = 0
+    for scorr_block, rcorr_block in corr_block_pairs(f"{path}/{scorr_file}", f"{path}/{rcorr_file}", block_size=block_size, cache=cache):
+        # the lowest errors (and with them the threshold) are updated after every chunk of rows,
+        # so the pruning starts as soon as num_errors errors are known and not only with the second block
+        for start in range(0, scorr_block.shape[0], PRUNE_ROWS):
+            stop = start + PRUNE_ROWS
+            scorr = scorr_block[start:stop]
+            rcorr = rcorr_block[start:stop] if rcorr_block.shape[0] > 1 else rcorr_block
+            threshold = lowest_errors[-1] + margin if len(lowest_errors) == num_errors else np.inf
+
+            alive = np.arange(scorr.shape[0])
+            partial = np.zeros(scorr.shape[0], dtype='float64')
+            for col in range(0, len(order), PRUNE_STEP):
+                if not np.isfinite(threshold) or alive.size == 0:
+                    break
+                cols = order[col:col + PRUNE_STEP] + 1
+                random = rcorr[alive] if rcorr.shape[0] > 1 else rcorr
+                partial[alive] += (weights[cols - 1] * np.abs(scorr[alive][:, cols] - random[:, cols])).sum(axis=1)
+                alive = alive[partial[alive] <= threshold]
+
+            # the surviving sqs get their exact error, summed in the same order as in compare_correlations
+            random = rcorr[alive] if rcorr.shape[0] > 1 else rcorr
+            errors = weighted_errors(scorr[alive], random, weights)[:, 0]
+            scored += alive.size
+
+            for idx, value in zip(alive.tolist(), errors.tolist()):
+                error = round(value, int(precision))
+                if len(lowest_errors) == num_errors and error > lowest_errors[-1]:
+                    continue
+
+                pos = bisect.bisect_left(lowest_errors, error)
+                if pos == len(lowest_errors) or lowest_errors[pos] != error:
+                    lowest_errors.insert(pos, error)
+                    if len(lowest_errors) > num_errors:
+                        dropped = lowest_errors.pop()
+                        kept = {key: value for key, value in kept.items() if value != dropped}
+                kept[offset + start + idx] = error
+
+        offset += scorr_block.shape[0]
+
+    if verbose > 0:
+        print(f"{path}: exact errors of {scored} of {offset} sqs")
+
+    important_sqs = {error:[] for error in lowest_errors}
+    for idx, sqs in select_candidates(f"{path}/{sqs_file}", kept).items():
+        important_sqs[kept[idx]].append(sqs)
 
     return important_sqs
 
 
-def determine_sym_unique(sqs_dict):
+def determine_sym_unique(sqs_dict, lattice_file=None, verify=False, symprec=1e-2):
     """
-    Input is a dictionary with the errors as keys and a list of all sqs with the error as the value, the function returns a dictionary of the same form, however sqs of the same symmetry are combined
+    Input is a dictionary with the errors as keys and a list of all sqs with the error as the value, the function returns a dictionary of the same form, however sqs of the same symmetry are combined.
+    With a lattice_file (lat.in of the candidates) the sqs are compared by their canonical occupation keys, otherwise (or to verify the keys,
+    or if the sqs can't be mapped onto the lat.in) with pymatgen's StructureMatcher
     """
-    # Initialize the StructureMatcher
+    if lattice_file is None:
+        return match_sym_unique(sqs_dict)
+
+    try:
+        keys = occupation_keys(sqs_dict, lattice_file, symprec)
+    except ValueError as error:
+        print(f"{error}, the symmetry unique sqs are determined with the StructureMatcher")
+        return match_sym_unique(sqs_dict)
+
+    out = {}
+    for error, error_sqs in sqs_dict.items():
+        seen = set()
+        out[error] = []
+
+        for sqs, key in zip(error_sqs, keys[error]):
+            if key in seen:
+                continue
+            seen.add(key)
+            out[error].append(Mcsqs.structure_from_str("\n".join(sqs)))
+
+    if verify:
+        verify_sym_unique(out, sqs_dict)
+
+    return out
+
+
+def match_sym_unique(sqs_dict):
+    # pairwise comparison with the StructureMatcher, quadratic in the number of sqs per error
     matcher = StructureMatcher()
 
     def check_sym(error_str, new_str):
@@ -157,6 +336,70 @@ def determine_sym_unique(sqs_dict):
     return out
 
 
+def verify_sym_unique(unique_sqs, sqs_dict):
+    # cross-check of the canonical keys with the StructureMatcher
+    reference = match_sym_unique(sqs_dict)
+    for error in sqs_dict.keys():
+        if len(reference[error]) != len(unique_sqs[error]):
+            raise ValueError(f"The canonical keys give {len(unique_sqs[error])} symmetry unique sqs with the error {error}, the StructureMatcher {len(reference[error])}")
+    print(f"The canonical keys agree with the StructureMatcher ({sum([len(sqs) for sqs in unique_sqs.values()])} sqs)")
+
+
+def occupation_keys(sqs_dict, lattice_file, symprec=1e-2, block_size=KEY_BLOCK_SIZE):
+    """
+    Input:
+    * sqs_dict - {error: list of sqs (lines of sqs.out)}
+    * lattice_file - path of the lat.in the candidates were generated for
+    * symprec - tolerance (in Angstrom) of the symmetry detection of the lat.in, the same as the one of the candidate generation
+    * block_size - number of candidates per batch of canonical_keys
+
+    Use --> every candidate is a supercell of the parent lattice of the lat.in, so it is described by the occupation of its mixing sites
+            (index into the species of the site). Two candidates are symmetry equivalent if a permutation of the mixing sites by a symmetry
+            operation of the parent lattice maps one occupation onto the other, so the lexicographically smallest occupation over all
+            operations is the same. Candidates are grouped by their geometry (cell and positions), every geometry gets its own permutations
+
+    Returns => {error: list of hashable keys, one per sqs}
+    """
+    coordinate_system, cell, positions, species = tools.read_lattice_file(lattice_file)
+    inv_cell = np.linalg.inv(cell)
+    labels = [site[0] for site in species]
+    base_structure = Structure(Lattice(cell @ coordinate_system), labels, positions @ inv_cell)
+    num_species = max([len(site) for site in species])
+
+    geometries = {}
+    for error, error_sqs in sqs_dict.items():
+        for idx, sqs in enumerate(error_sqs):
+            lines = [line.split() for line in sqs if line.strip() != '' and line.strip() != 'end']
+            geometry = tuple([" ".join(line[:3]) for line in lines])
+            geometries.setdefault(geometry, []).append((error, idx, [line[3] for line in lines[6:]]))
+
+    keys = {error: [None] * len(error_sqs) for error, error_sqs in sqs_dict.items()}
+    for geometry, members in geometries.items():
+        if not np.allclose(np.array([row.split() for row in geometry[:3]], dtype='float64'), coordinate_system, atol=1e-5):
+            raise ValueError("The candidates and the lat.in don't share the same coordinate system")
+        sqs_cell = np.array([row.split() for row in geometry[3:6]], dtype='float64')
+        sqs_positions = np.array([row.split() for row in geometry[6:]], dtype='float64').reshape(-1, 3)
+        supercell = sqs_cell @ inv_cell
+        if not np.allclose(supercell, np.round(supercell), atol=1e-3):
+            raise ValueError("The cell of the candidates is no supercell of the lat.in")
+
+        # mixing atoms of the candidates and the species their occupation indexes into
+        structure = Structure(Lattice(sqs_cell @ coordinate_system), members[0][2], sqs_positions @ np.linalg.inv(sqs_cell))
+        sites, _ = parent_sites(sqs_positions @ inv_cell, base_structure.frac_coords, base_structure.lattice.matrix, symprec)
+        subset = [idx for idx, site in enumerate(sites) if len(species[site]) > 1]
+
+        permutations = parent_permutations(structure, subset, base_structure, np.round(supercell), symprec)
+        weights, _ = canonical_weights(permutations, len(subset), num_species)
+
+        occupations = np.array([[species[sites[idx]].index(symbols[idx]) for idx in subset] for _, _, symbols in members], dtype='uint8')
+        for start in range(0, len(members), block_size):
+            block = canonical_keys(occupations[start:start + block_size], weights)
+            for (error, idx, _), key in zip(members[start:start + block_size], block):
+                keys[error][idx] = key.tobytes()
+
+    return keys
+
+
 def select_best_sqs(sqs_dict, num_best, verbose):
     #writes best_sqs as a conc.in type file (for further refinement) and as Vasp POSCARS
     best_sqs = []
@@ -186,7 +429,8 @@ def write_unique_errors(path, unique_sqs):
     print(path)
     output = ""
     for error in unique_sqs.keys():
-        output += f"{error}\n" * len(unique_sqs[error])
+        line = "\t".join([f"{value}" for value in error]) if isinstance(error, tuple) else f"{error}"
+        output += f"{line}\n" * len(unique_sqs[error])
 
     with open(path, 'w') as f:
         f.write(output)
@@ -0,0 +1,145 @@
+import heapq
+
+import numpy as np
+
+from config_generator import canonical_keys, canonical_weights
+from compare_correlations import cluster_weights
+
+
+""" Simulated annealing search for the candidates with the lowest correlation error (binary mixing site only)
+
+    The state is the occupation of the mixing sites of one supercell (-1 for the first, +1 for the second species),
+    a move exchanges the species of two sites, so the concentration is fixed. The product of the occupations of every
+    cluster in the supercell is kept, a swap only flips the products of the clusters that contain exactly one of the
+    two sites an odd number of times, so the correlations are updated without touching the rest of the supercell.
+    The error is the damped error of compare_correlations with respect to the random alloy.
+"""
+
+class AnnealingSearch:
+
+    def __init__(self, engine, damping: float, permutations: np.ndarray):
+        """
+        Input:
+        * engine - CorrelationEngine of the supercell, its mixing sites are the sites of the search
+        * damping - damping constant of the error, as in compare_correlations
+        * permutations - permutations of the mixing sites under the symmetry operations of the supercell, used to
+                         tell symmetry equivalent configurations apart (identity only if no symmetry should be used)
+
+        Use --> flattens the clusters of all orbits of the engine into one list:
+                    self.cluster_column - correlation column of every cluster in the supercell
+                    self.site_clusters - per mixing site the clusters whose product changes sign if the site flips
+                    self.multiplicities - number of clusters in the supercell per correlation column
+
+        Returns => None
+        """
+        self.num_sites = len(engine.mixing_atoms)
+        self.weights = cluster_weights(engine.clusters, damping)
+        self.num_nodes = engine.clusters.num_nodes
+
+        self.cluster_column = np.concatenate([np.full(sites.shape[0], col, dtype='int64') for col, sites in enumerate(engine.orbit_sites)])
+        self.multiplicities = np.bincount(self.cluster_column, minlength=len(engine.orbit_sites)).astype('float64')
+        self.orbit_sites = engine.orbit_sites
+
+        # (site, cluster) pairs of all nodes, a site occurring twice in a (wrapped around) cluster doesn't change its sign
+        offsets = np.cumsum([0] + [sites.shape[0] for sites in engine.orbit_sites])
+        site_ids = np.concatenate([sites.ravel() for sites in engine.orbit_sites])
+        cluster_ids = np.concatenate([np.repeat(np.arange(start, stop), sites.shape[1]) for start, stop, sites in zip(offsets[:-1], offsets[1:], engine.orbit_sites)])
+        pairs, counts = np.unique(site_ids * offsets[-1] + cluster_ids, return_counts=True)
+        pairs = pairs[counts % 2 == 1]
+        self.site_clusters = np.split(pairs % offsets[-1], np.searchsorted(pairs // offsets[-1], np.arange(1, self.num_sites)))
+
+        permutations = np.unique(permutations, axis=0)
+        self.key_weights, _ = canonical_weights(permutations, self.num_sites)
+
+
+    def products(self, sigma):
+        # product of the occupations of every cluster in the supercell
+        return np.concatenate([np.prod(sigma[sites], axis=1, dtype='int8') for sites in self.orbit_sites])
+
+
+    def error(self, sums, rcorr):
+        return float(np.dot(self.weights, np.abs(sums[1:]/self.multiplicities[1:] - rcorr[1:])))
+
+
+    def key(self, sigma):
+        return canonical_keys((sigma > 0).astype('uint8')[np.newaxis, :], self.key_weights)[0].tobytes()
+
+
+    def run(self, num_sub, steps, t_start, t_stop, num_best, seed):
+        """
+        Input:
+        * num_sub - number of mixing sites with the second species
+        * steps - number of attempted swaps
+        * t_start, t_stop - temperature (in units of the error) of the first and last step, geometric in between
+        * num_best - number of symmetry distinct configurations kept
+        * seed - seed of the chain, anything numpy.random.default_rng accepts
+
+        Use --> one Metropolis chain from a random configuration, remembering the lowest error configurations it visits
+
+        Returns => list of (error, canonical key, uint8 configuration with 1 for the second species), lowest error first
+        """
+        rng = np.random.default_rng(seed)
+        rcorr = (2*num_sub/self.num_sites - 1)**self.num_nodes.astype('float64')
+
+        sigma = -np.ones(self.num_sites, dtype='int8')
+        sigma[rng.choice(self.num_sites, size=num_sub, replace=False)] = 1
+        prod = self.products(sigma)
+        sums = np.bincount(self.cluster_column, weights=prod, minlength=len(self.multiplicities))
+        error = self.error(sums, rcorr)
+
+        # heap of the best configurations, the worst one on top
+        best = []
+        keys = set()
+        self.remember(best, keys, error, sigma, num_best)
+
+        minus = np.flatnonzero(sigma < 0)
+        plus = np.flatnonzero(sigma > 0)
+        if len(minus) == 0 or len(plus) == 0:
+            return self.ranked(best)
+
+        temperatures = t_start * (t_stop/t_start)**(np.arange(steps)/max(steps - 1, 1))
+        picks_minus = rng.integers(len(minus), size=steps)
+        picks_plus = rng.integers(len(plus), size=steps)
+        thresholds = np.log(rng.random(steps))
+
+        for step in range(steps):
+            a, b = minus[picks_minus[step]], plus[picks_plus[step]]
+            flipped = np.setxor1d(self.site_clusters[a], self.site_clusters[b], assume_unique=True)
+            new_sums = sums - 2*np.bincount(self.cluster_column[flipped], weights=prod[flipped], minlength=len(sums))
+            new_error = self.error(new_sums, rcorr)
+
+            if new_error > error and (new_error - error)/temperatures[step] > -thresholds[step]:
+                continue
+
+            prod[flipped] *= -1
+            sums, error = new_sums, new_error
+            sigma[a], sigma[b] = 1, -1
+            minus[picks_minus[step]], plus[picks_plus[step]] = b, a
+
+            if len(best) < num_best or error < -best[0][0]:
+                self.remember(best, keys, error, sigma, num_best)
+
+        return self.ranked(best)
+
+
+    def remember(self, best, keys, error, sigma, num_best):
+        key = self.key(sigma)
+        if key in keys:
+            return
+        keys.add(key)
+        heapq.heappush(best, (-error, key, (sigma > 0).astype('uint8')))
+        if len(best) > num_best:
+            keys.discard(heapq.heappop(best)[1])
+
+
+    @staticmethod
+    def ranked(best):
+        return sorted([(-neg_error, key, config) for neg_error, key, config in best], key=lambda item: (item[0], item[1]))
+
+
+def merge_chains(results, num_best):
+    # lowest error symmetry distinct configurations of several chains
+    merged = {}
+    for error, key, config in sorted([item for result in results for item in result], key=lambda item: (item[0], item[1])):
+        merged.setdefault(key, (error, config))
+    return sorted(merged.values(), key=lambda item: item[0])[:num_best]
@@ -0,0 +1,232 @@
+import os
+import math
+import hashlib
+import tempfile
+from collections import Counter
+
+import numpy as np
+import spglib
+
+# bsym is only needed to detect the symmetry of the supercell and for its configuration spaces (--mode unique, all),
+# the permutations built from the parent cell and the native enumeration work without it
+try:
+    import bsym.interface.pymatgen as ipmg
+    from bsym import ConfigurationSpace, SpaceGroup, SymmetryOperation
+    HAS_BSYM = True
+except ImportError:
+    HAS_BSYM = False
+
+
+""" Symmetry operations of a supercell as permutations of its mixing sites: on-disk cache for bsym and counting
+
+    Finding the symmetry operations of a supercell (spglib + coordinate mapping in bsym) is the same for every
+    concentration. The operations are stored as permutations of the mixing sites in '{cache_dir}/{key}.npy',
+    the key being a hash of the supercell structure, the mixing subset and the tolerance.
+    The same permutations give the number of symmetry unique candidates without enumerating them.
+    Alternatively the permutations are built from the symmetry of the parent cell, which needs neither detection nor cache.
+"""
+
+# changes whenever the content of the cache files changes, so old caches are not picked up
+SYMMETRY_CACHE_VERSION = 1
+
+
+def configuration_space(structure, subset, atol=1e-5, cache_dir=None, parent=None):
+    """
+    Input:
+    * structure - pymatgen supercell structure
+    * subset - indices of the mixing sites in structure
+    * atol - tolerance of the coordinate mapping of bsym
+    * cache_dir - directory of the permutation cache, None for no cache. Only used when the symmetry is detected (parent None)
+    * parent - (parent structure, supercell matrix[, symprec]) of structure, None to detect the symmetry of the supercell
+
+    Use --> same as bsym's configuration_space_from_structure, but the permutations of the symmetry operations
+            are read from the cache if they were already determined for the same input, or built from the parent cell
+
+    Returns => bsym ConfigurationSpace
+    """
+    require_bsym("the configuration space of the unique mode")
+    if cache_dir is None and parent is None:
+        return ipmg.configuration_space_from_structure(structure, subset=subset, atol=atol)
+
+    permutations = symmetry_permutations(structure, subset, atol, cache_dir, parent)
+    symmetry_operations = [SymmetryOperation.from_vector(vector, count_from_zero=True) for vector in permutations.tolist()]
+    return ConfigurationSpace(objects=list(subset), symmetry_group=SpaceGroup(symmetry_operations=symmetry_operations))
+
+
+def symmetry_permutations(structure, subset, atol=1e-5, cache_dir=None, parent=None):
+    # permutations of the mixing sites under the symmetry operations of the supercell, one row per operation.
+    # the ones built from the parent cell are cheap, only the detected ones go through the cache
+    if parent is not None:
+        return parent_permutations(structure, subset, *parent)
+
+    path = f"{cache_dir}/{symmetry_key(structure, subset, atol)}.npy"
+    permutations = load_permutations(path, len(subset)) if cache_dir is not None else None
+    if permutations is not None:
+        return permutations
+
+    require_bsym("detecting the symmetry of the supercell (--detect_symmetry)")
+    config_space = ipmg.configuration_space_from_structure(structure, subset=subset, atol=atol)
+    permutations = np.array([operation.as_vector(count_from_zero=True) for operation in config_space.symmetry_group.symmetry_operations], dtype='int64')
+    if cache_dir is not None:
+        save_permutations(path, permutations)
+    return permutations
+
+
+def require_bsym(purpose):
+    if not HAS_BSYM:
+        raise ImportError(f"bsym is needed for {purpose}, the native mode with the symmetry of the parent cell works without it")
+
+
+def parent_permutations(structure, subset, base_structure, supercell, symprec=1e-2):
+    """
+    Input:
+    * structure - supercell structure, base_structure.make_supercell(supercell)
+    * subset - indices of the mixing sites in structure
+    * base_structure - pymatgen structure of the parent cell
+    * supercell - integer supercell matrix (rows in units of the parent cell vectors)
+    * symprec - tolerance (in Angstrom) of the symmetry detection of the parent cell, the default of pymatgen's SpacegroupAnalyzer used by bsym
+
+    Use --> the symmetry operations of the supercell are the ones of the parent cell that map the superlattice onto itself,
+            combined with the translations by the parent lattice vectors inside the supercell. Every mixing site is a parent site
+            plus a parent lattice vector, so the permutations follow from integer arithmetic on these pairs
+
+    Returns => int64 array of the distinct permutations of the mixing sites, one row per operation
+    """
+    supercell = np.round(np.array(supercell, dtype='float64')).astype('int64')
+    det = int(round(abs(np.linalg.det(supercell))))
+    # cells @ adjugate / det are the fractional coordinates in the supercell, so the numerators mod det identify the cell in the supercell
+    adjugate = np.round(np.linalg.inv(supercell) * det).astype('int64')
+
+    def keys(sites, cells):
+        numerators = (cells @ adjugate) % det
+        return ((sites * det + numerators[..., 0]) * det + numerators[..., 1]) * det + numerators[..., 2]
+
+    lattice = base_structure.lattice.matrix
+    points = structure.frac_coords[subset] @ supercell
+    sites, cells = parent_sites(points, base_structure.frac_coords, lattice, symprec)
+    reference = keys(sites, cells)
+    order = np.argsort(reference)
+    if len(np.unique(reference)) != len(subset):
+        raise ValueError("Two mixing sites of the supercell occupy the same parent site")
+
+    # the cells of the copies of one parent site are the translations of the supercell
+    translations = cells[sites == sites[0]] - cells[0]
+    if len(translations) != det:
+        raise ValueError("The mixing sites don't cover the supercell")
+
+    symmetry = spglib.get_symmetry((lattice, base_structure.frac_coords, [el.Z for el in base_structure.species]), symprec=symprec)
+    permutations = []
+    for rotation, translation in zip(symmetry['rotations'], symmetry['translations']):
+        # the superlattice has to be invariant: supercell @ rotation^T @ supercell^-1 is an integer matrix
+        if np.any((supercell @ rotation.T @ adjugate) % det != 0):
+            continue
+
+        new_sites, new_cells = parent_sites(points @ rotation.T + translation, base_structure.frac_coords, lattice, symprec)
+        mapped = keys(new_sites[np.newaxis, :], new_cells[np.newaxis, :, :] + translations[:, np.newaxis, :])
+        idx = np.searchsorted(reference[order], mapped)
+        if np.any(reference[order][np.minimum(idx, len(order) - 1)] != mapped):
+            raise ValueError("A symmetry operation of the parent cell maps a mixing site onto a site that is no mixing site")
+        permutations.append(order[idx])
+
+    return np.unique(np.concatenate(permutations, axis=0), axis=0)
+
+
+def parent_sites(points, site_frac, lattice, symprec):
+    # parent site and parent lattice vector of every point (fractional coordinates of the parent cell)
+    diff = points[:, np.newaxis, :] - site_frac[np.newaxis, :, :]
+    err = np.linalg.norm((diff - np.round(diff)) @ lattice, axis=2)
+    sites = np.argmin(err, axis=1)
+
+    if np.any(err[np.arange(len(sites)), sites] > symprec):
+        raise ValueError("Point does not lie on a site of the parent cell")
+
+    cells = np.round(diff[np.arange(len(sites)), sites]).astype('int64')
+    return sites, cells
+
+
+def count_unique_compositions(permutations, counts):
+    """
+    Input:
+    * permutations - permutations of the mixing sites, e.g. from symmetry_permutations
+    * counts - number of sites of every species
+
+    Use --> Burnside/Polya counting: the number of symmetry inequivalent configurations with counts[s] sites of species s
+            is the coefficient of prod_s x_s^counts[s] in the mean over the group of prod over the cycles of (sum_s x_s^(cycle length))
+
+    Returns => number of symmetry unique configurations
+    """
+    # the operations may contain duplicate permutations, the group acting on the sites is the set of distinct ones
+    permutations = np.unique(permutations, axis=0)
+    cycle_types = Counter([cycle_type(permutation) for permutation in permutations.tolist()])
+
+    total = 0
+    for cycles, multiplicity in cycle_types.items():
+        # coefficients of the product so far as {sites per species: coefficient}, terms beyond counts are dropped
+        poly = {(0,) * len(counts): 1}
+        for length in cycles:
+            product = {}
+            for used, coeff in poly.items():
+                for species in range(len(counts)):
+                    if used[species] + length <= counts[species]:
+                        key = used[:species] + (used[species] + length,) + used[species + 1:]
+                        product[key] = product.get(key, 0) + coeff
+            poly = product
+        total += multiplicity * poly.get(tuple(counts), 0)
+
+    return total // len(permutations)
+
+
+def cycle_type(permutation):
+    lengths = []
+    seen = [False] * len(permutation)
+    for start in range(len(permutation)):
+        length = 0
+        site = start
+        while not seen[site]:
+            seen[site] = True
+            site = permutation[site]
+            length += 1
+        if length > 0:
+            lengths.append(length)
+    return tuple(sorted(lengths))
+
+
+def count_configurations(counts):
+    # multinomial coefficient, all arrangements of counts[s] sites of species s
+    total = math.factorial(sum(counts))
+    for count in counts:
+        total //= math.factorial(count)
+    return total
+
+
+def symmetry_key(structure, subset, atol):
+    sha = hashlib.sha256()
+    sha.update(f"{SYMMETRY_CACHE_VERSION} {atol!r} {[el.symbol for el in structure.species]} {list(subset)}".encode())
+    sha.update(np.ascontiguousarray(structure.lattice.matrix, dtype='float64').tobytes())
+    sha.update(np.ascontiguousarray(structure.frac_coords, dtype='float64').tobytes())
+    return sha.hexdigest()
+
+
+def load_permutations(path, num_sites):
+    # None if there is no (usable) cache
+    try:
+        permutations = np.load(path, allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+    if permutations.ndim != 2 or permutations.shape[1] != num_sites:
+        return None
+    return permutations
+
+
+def save_permutations(path, permutations):
+    # written to a temporary file first, so concurrent runs never read a partial cache
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, permutations)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
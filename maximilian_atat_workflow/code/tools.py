@@ -1,7 +1,14 @@
 import os
 import sys
+import json
+import hashlib
+import itertools
 import numpy as np
-from cluster import Cluster
+from cluster import Cluster, ClusterSet
+from candidate_store import CandidateStore, store_path
+
+
+CORR_BLOCK_SIZE = 100000
 
 
 def check_wdir(base_path, paths):
@@ -22,7 +29,62 @@ def get_coordinate_system(path):
     return coordinate_system
     
     
-def read_out_cluster_file(path, coordinate_system):
+def parse_lattice_lines(lines):
+    # lat.in style structure (lat.in or a single sqs of sqs.out): coordinate system, unit cell (in units of the coordinate system),
+    # atom positions (in units of the coordinate system) and the list of possible species per atom
+    lines = [line for line in lines if line.strip() != '' and line.strip() != 'end']
+
+    coordinate_system = np.array([line.split()[:3] for line in lines[:3]], dtype='float64')
+    cell = np.array([line.split()[:3] for line in lines[3:6]], dtype='float64')
+    positions = np.array([line.split()[:3] for line in lines[6:]], dtype='float64').reshape(-1, 3)
+    species = [[el.strip() for el in " ".join(line.split()[3:]).split(',') if el.strip() != ''] for line in lines[6:]]
+
+    return coordinate_system, cell, positions, species
+
+
+def read_lattice_file(path):
+    with open(path, 'r') as f:
+        return parse_lattice_lines(f.readlines())
+
+
+def read_lattice_mixing_species(path):
+    # species of the mixing site(s) in a lat.in, e.g. ['Nb', 'Ta'] for the site '... Nb, Ta'
+    with open(path, 'r') as f:
+        lines = f.readlines()
+
+    mixing_species = []
+    for line in lines[6:]:
+        species = [el.strip() for el in " ".join(line.split()[3:]).split(',') if el.strip() != '']
+        if len(species) > 1 and species not in mixing_species:
+            mixing_species.append(species)
+
+    return mixing_species
+
+
+def mirror_folders(calc_path, lattice_path, candidate_file):
+    # concentration folders sqs_k with k < N-k and the folder name of their mirror sqs_(N-k), N being the number of mixing atoms.
+    # exchanging the two species of a binary mixing site maps the one onto the other
+    mixing_species = read_lattice_mixing_species(lattice_path)
+    if len(mixing_species) != 1 or len(mixing_species[0]) != 2:
+        raise ValueError(f"Mirroring the concentrations needs exactly one binary mixing site, found {mixing_species} in {lattice_path}")
+
+    folders = sorted([folder for folder in os.listdir(calc_path) if folder.startswith('sqs_')])
+    if os.path.exists(f"{calc_path}/{folders[0]}/{candidate_file}"):
+        with open(f"{calc_path}/{folders[0]}/{candidate_file}", 'r') as f:
+            lines = [line for line in itertools.takewhile(lambda line: line.strip() != 'end', f) if line.strip() != '']
+    else:
+        lines = CandidateStore(f"{calc_path}/{folders[0]}/{store_path(candidate_file)}").lines(0)
+    num_mixing = sum([line.split()[3] in mixing_species[0] for line in lines[6:]])
+
+    mirrors = {}
+    for folder in folders:
+        conc = int(folder.split('_')[-1])
+        if conc < num_mixing - conc:
+            mirrors[folder] = f"sqs_{num_mixing - conc:0>{len(str(num_mixing))}}"
+    return mirrors
+
+
+def read_out_cluster_file(path, coordinate_system, verify=False):
     try:
         clusters_file = open(path, 'r')
     except:
@@ -39,20 +101,168 @@ def read_out_cluster_file(path, coordinate_system):
             clusters.append(Cluster(data, coordinate_system))
             data = []
 
-    return clusters
+    return ClusterSet(clusters, verify=verify)
 
 
-def read_out_corr_file(path):
+def read_out_corr_file(path, cache=False):
     try:
-        corr_file = open(path, 'r')
+        corr_file = open(path, 'rb')
     except:
         print(f"\nFile {path} not found.")
         sys.exit()
 
-    lines = corr_file.readlines()
+    # with cache the binary sidecar is memory-mapped, so repeated stages neither re-parse nor copy the table.
+    # it is written next to the correlation file, so only stages that re-read large files turn it on
+    if cache:
+        arr = load_corr_cache(path)
+        if arr is not None:
+            corr_file.close()
+            return arr, arr.shape[0], arr.shape[1]
+
+    content = corr_file.read()
+    corr_file.close()
+    lines = content.decode().splitlines()
 
     arr = np.array([line.split() for line in lines], dtype='float32')
     num_cand = len(lines)
     num_clus = len(lines[0].split())
+
+    if cache:
+        write_corr_cache(path, arr, hashlib.sha256(content).hexdigest())
     
-    return arr, num_cand, num_clus
\ No newline at end of file
+    return arr, num_cand, num_clus
+
+
+def read_out_corr_blocks(path, block_size=CORR_BLOCK_SIZE, cache=False):
+    # generator version of read_out_corr_file - yields float32 blocks of at most block_size rows,
+    # so the memory is bounded by the block size instead of the number of candidates
+    if not os.path.exists(path):
+        print(f"\nFile {path} not found.")
+        sys.exit()
+
+    if cache:
+        arr = load_corr_cache(path)
+        if arr is not None:
+            for start in range(0, arr.shape[0], block_size):
+                yield arr[start:start + block_size]
+            return
+
+    # the cache is filled block by block while streaming - for that its shape has to be known beforehand
+    cache_arr = None
+    if cache:
+        num_cand, num_clus, sha256 = scan_corr_file(path)
+        cache_path, _ = corr_cache_paths(path)
+        try:
+            cache_arr = np.lib.format.open_memmap(f"{cache_path}.tmp", mode='w+', dtype='float32', shape=(num_cand, num_clus))
+        except (OSError, ValueError):
+            cache_arr = None
+
+    start = 0
+    try:
+        with open(path, 'r') as corr_file:
+            while True:
+                lines = list(itertools.islice(corr_file, block_size))
+                if not lines:
+                    break
+
+                block = np.array([line.split() for line in lines], dtype='float32')
+                if cache_arr is not None:
+                    cache_arr[start:start + block.shape[0]] = block
+                start += block.shape[0]
+                yield block
+
+        if cache_arr is not None:
+            cache_arr.flush()
+            cache_arr = None
+            try:
+                finish_corr_cache(path, sha256)
+            except OSError:
+                pass
+    finally:
+        # stream wasn't read to the end (or failed) - don't leave a partial cache behind
+        if cache_arr is not None:
+            cache_arr = None
+            if os.path.exists(f"{corr_cache_paths(path)[0]}.tmp"):
+                os.remove(f"{corr_cache_paths(path)[0]}.tmp")
+
+
+def scan_corr_file(path):
+    # number of rows and columns and the hash of a correlation file without holding it in memory
+    sha = hashlib.sha256()
+    num_cand = 0
+    num_clus = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            if num_cand == 0 and num_clus == 0:
+                num_clus = len(block.split(b'\n', 1)[0].split())
+            sha.update(block)
+            num_cand += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        num_cand += 1
+    return num_cand, num_clus, sha.hexdigest()
+
+
+def corr_cache_paths(path):
+    return f"{path}.npy", f"{path}.npy.json"
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_corr_cache(path):
+    # returns the cached table of a correlation file or None if there is no valid cache
+    cache_path, meta_path = corr_cache_paths(path)
+    if not (os.path.exists(cache_path) and os.path.exists(meta_path)):
+        return None
+
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        stat = os.stat(path)
+
+        if meta['size'] != stat.st_size:
+            return None
+
+        # a changed mtime alone (e.g. a copy of the calc folder) doesn't invalidate the cache if the content is the same
+        if meta['mtime_ns'] != stat.st_mtime_ns:
+            if meta['sha256'] != file_hash(path):
+                return None
+            meta['mtime_ns'] = stat.st_mtime_ns
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+        arr = np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if arr.ndim != 2 or arr.dtype != np.float32:
+        return None
+    return arr
+
+
+def write_corr_cache(path, arr, sha256):
+    cache_path, _ = corr_cache_paths(path)
+    try:
+        # write to a temporary file first, so a crash never leaves a half-written cache behind
+        with open(f"{cache_path}.tmp", 'wb') as f:
+            np.save(f, arr)
+        finish_corr_cache(path, sha256)
+    except OSError:
+        # no write permission or full disk - the cache is just an optimization
+        pass
+
+
+def finish_corr_cache(path, sha256):
+    cache_path, meta_path = corr_cache_paths(path)
+    stat = os.stat(path)
+    os.replace(f"{cache_path}.tmp", cache_path)
+
+    with open(meta_path, 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}, f)